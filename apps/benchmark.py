@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Benchmark the classification pipeline on synthetic granules
+
+Each stage is timed separately, and each result is written as a JSON
+line, so that runs can be appended to one file and compared over time.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import classify
+import features
+import photon_io
+import score
+import synthetic
+
+STAGES = ['read', 'mask', 'density', 'features', 'predict', 'write', 'score']
+
+
+def get_commit():
+
+    # The commit being benchmarked, if this is a git checkout
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_stages(input_filename, output_filename, model_filename, nthread):
+
+    # Returns the seconds taken by each stage
+    seconds = {}
+
+    t0 = time.perf_counter()
+    df = photon_io.read_photons(input_filename, classify.INPUT_COLUMNS)
+    t1 = time.perf_counter()
+    seconds['read'] = t1 - t0
+
+    mask = features.bathy_mask(df)
+    t2 = time.perf_counter()
+    seconds['mask'] = t2 - t1
+
+    density = features.get_density(df, mask)
+    t3 = time.perf_counter()
+    seconds['density'] = t3 - t2
+
+    x = features.get_features(df, density)
+    t4 = time.perf_counter()
+    seconds['features'] = t4 - t3
+
+    clf = classify.load_model(model_filename, nthread)
+    t5 = time.perf_counter()
+    classify.predict(clf, x)
+    t6 = time.perf_counter()
+    seconds['predict'] = t6 - t5
+
+    # Write and score the same output table that classify writes
+    df = classify.classify(df, False, model_filename, density, nthread)
+    t7 = time.perf_counter()
+    photon_io.write_photons(df, output_filename)
+    t8 = time.perf_counter()
+    seconds['write'] = t8 - t7
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        score.score(df, score.ALGORITHMS, True, False)
+    t9 = time.perf_counter()
+    seconds['score'] = t9 - t8
+
+    return seconds
+
+
+def main(args):
+
+    # Show args
+    if args.verbose:
+        print(args, file=sys.stderr)
+
+    model_filename = classify.MODELS.resolve(args.model_filename)
+
+    # Common fields of every result
+    run = {
+        'commit': get_commit(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'model': os.path.basename(model_filename),
+        'seed': args.seed,
+        'nthread': args.nthread,
+        }
+
+    # Load the model before anything is timed
+    classify.load_model(model_filename, args.nthread)
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+
+            n = int(size)
+            df = synthetic.get_granule(n, args.seed)
+
+            for fmt in args.formats:
+
+                ext = classify.OUTPUT_EXTENSIONS[fmt]
+                input_filename = os.path.join(tmp, f'granule{ext}')
+                output_filename = os.path.join(tmp, f'classified{ext}')
+                photon_io.write_photons(df, input_filename)
+
+                if args.verbose:
+                    print(f'Benchmarking {n} photons in {fmt} format',
+                          file=sys.stderr)
+
+                # Keep the fastest of the repeats
+                best = {}
+                for _ in range(args.repeat):
+                    seconds = run_stages(input_filename,
+                                         output_filename,
+                                         model_filename,
+                                         args.nthread)
+                    for stage, s in seconds.items():
+                        best[stage] = min(s, best.get(stage, s))
+
+                for stage in STAGES:
+                    result = dict(run,
+                                  stage=stage,
+                                  format=fmt,
+                                  rows=n,
+                                  repeat=args.repeat,
+                                  seconds=round(best[stage], 6),
+                                  rows_per_sec=round(n / best[stage]))
+                    print(json.dumps(result), file=output, flush=True)
+
+    if output is not sys.stdout:
+        output.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Pipeline benchmark on synthetic granules')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Show verbose output')
+    parser.add_argument(
+        '-m', '--model-filename', default='latest',
+        help="Model filename, date (YYYYMMDD) or 'latest'")
+    parser.add_argument(
+        '-f', '--formats', nargs='+', default=['csv'],
+        choices=classify.OUTPUT_EXTENSIONS.keys(),
+        help='Granule file formats to benchmark')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='Number of runs of each size, keeping the fastest')
+    parser.add_argument(
+        '-s', '--seed', type=int, default=0,
+        help='Random seed')
+    parser.add_argument(
+        '-t', '--nthread', type=int, default=0,
+        help='Prediction threads, 0 for all cores')
+    parser.add_argument(
+        '-o', '--output',
+        help='Append results to this file instead of printing them')
+    parser.add_argument(
+        'sizes', type=float, nargs='*', default=[1e5, 1e6],
+        help='Number of photons per granule')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Benchmark the Local Outlier Factor engine against sklearn
+"""
+
+import argparse
+import sys
+import time
+import numpy as np
+import lof
+
+
+def get_points(n, seed):
+
+    # Along track candidate photons: sorted x_atc at roughly ATL03
+    # spacing, with a sloping seafloor plus scattered noise
+    rng = np.random.default_rng(seed)
+    x = np.sort(rng.uniform(0.0, 0.7 * n, n))
+    h = -5.0 - 10.0 * x / x[-1] + rng.normal(0.0, 0.5, n)
+    noise = rng.uniform(size=n) < 0.2
+    h[noise] = rng.uniform(-40.0, 0.0, noise.sum())
+    return np.column_stack([x, h])
+
+
+def main(args):
+
+    # Show args
+    if args.verbose:
+        print(args, file=sys.stderr)
+
+    print(f'n'
+          f'\tEngine'
+          f'\tSeconds'
+          f'\tPoints/sec'
+          f'\tMaxRelDiff'
+          f'\tOutsideTol')
+
+    for size in args.sizes:
+
+        n = int(size)
+        p = get_points(n, args.seed)
+
+        if args.verbose:
+            print(f'Computing LOF for {n} points', file=sys.stderr)
+
+        t0 = time.perf_counter()
+        nof = lof.negative_outlier_factor(p, args.n_neighbors, args.workers)
+        t1 = time.perf_counter()
+        print(f'{n}'
+              f'\tkdtree'
+              f'\t{t1 - t0:0.3f}'
+              f'\t{n / (t1 - t0):0.0f}'
+              f'\t'
+              f'\t')
+
+        if args.max_sklearn_size is not None and n > args.max_sklearn_size:
+            continue
+
+        t0 = time.perf_counter()
+        ref = lof.negative_outlier_factor_sklearn(p, args.n_neighbors)
+        t1 = time.perf_counter()
+        diff = np.abs(nof - ref) / np.abs(ref)
+        print(f'{n}'
+              f'\tsklearn'
+              f'\t{t1 - t0:0.3f}'
+              f'\t{n / (t1 - t0):0.0f}'
+              f'\t{diff.max():0.3g}'
+              f'\t{np.count_nonzero(diff > lof.RTOL)}')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Local Outlier Factor benchmark')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Show verbose output')
+    parser.add_argument(
+        '-n', '--n-neighbors', type=int, default=16,
+        help='Number of neighbors')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=-1,
+        help='Number of query threads, -1 for all cores')
+    parser.add_argument(
+        '-s', '--seed', type=int, default=0,
+        help='Random seed')
+    parser.add_argument(
+        '--max-sklearn-size', type=float,
+        help='Skip the sklearn baseline above this many points')
+    parser.add_argument(
+        'sizes', type=float, nargs='*', default=[1e5, 1e6, 1e7],
+        help='Number of candidate photons')
+
+    args = parser.parse_args()
+
+    main(args)
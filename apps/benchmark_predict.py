@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Benchmark batched inference against separate predict and predict_proba
+calls, and against a compiled Treelite model
+"""
+
+import argparse
+import sys
+import time
+import numpy as np
+import xgboost as xgb
+import classify
+import compiled_model
+import features
+import photon_io
+
+
+def main(args):
+
+    # Show args
+    if args.verbose:
+        print(args, file=sys.stderr)
+
+    df = photon_io.read_photons(args.input_filename, features.INPUT_COLUMNS)
+    x = features.get_features(df)
+    n = len(x)
+
+    print(f'n'
+          f'\tMethod'
+          f'\tThreads'
+          f'\tSeconds'
+          f'\tPhotons/sec'
+          f'\tMismatches'
+          f'\tMaxAbsDiff')
+
+    failed = False
+    for nthread in args.nthreads:
+
+        clf = xgb.XGBClassifier(device='cpu', nthread=nthread)
+        clf.load_model(args.model_filename)
+
+        if args.verbose:
+            print(f'Predicting {n} photons with {nthread} threads',
+                  file=sys.stderr)
+
+        # Two calls, as classify used to do
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            p_ref = clf.predict(x)
+            q_ref = clf.predict_proba(x)[:, 1]
+        t1 = time.perf_counter()
+        seconds = (t1 - t0) / args.repeat
+        print(f'{n}'
+              f'\tpredict+predict_proba'
+              f'\t{nthread}'
+              f'\t{seconds:0.3f}'
+              f'\t{n / seconds:0.0f}'
+              f'\t'
+              f'\t')
+
+        # One inplace_predict
+        clf = classify.load_model(args.model_filename, nthread)
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            p, q = classify.predict(clf, x)
+        t1 = time.perf_counter()
+        seconds = (t1 - t0) / args.repeat
+        print(f'{n}'
+              f'\tinplace_predict'
+              f'\t{nthread}'
+              f'\t{seconds:0.3f}'
+              f'\t{n / seconds:0.0f}'
+              f'\t{np.count_nonzero(p != p_ref)}'
+              f'\t{np.abs(q - q_ref).max():0.3g}')
+
+        if not args.treelite:
+            continue
+
+        # Compiled model. The first load compiles the model if needed.
+        clf = classify.load_model(args.model_filename, nthread, 'treelite')
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            p, q = classify.predict(clf, x)
+        t1 = time.perf_counter()
+        seconds = (t1 - t0) / args.repeat
+        diff = np.abs(q - q_ref).max()
+        print(f'{n}'
+              f'\ttreelite'
+              f'\t{nthread}'
+              f'\t{seconds:0.3f}'
+              f'\t{n / seconds:0.0f}'
+              f'\t{np.count_nonzero(p != p_ref)}'
+              f'\t{diff:0.3g}')
+
+        # Parity check against XGBoost
+        if diff > compiled_model.PARITY_ATOL or np.any(p != p_ref):
+            print('Compiled model predictions differ from XGBoost',
+                  file=sys.stderr)
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Inference benchmark')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Show verbose output')
+    parser.add_argument(
+        '-m', '--model-filename', required=True,
+        help='Model filename')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='Number of timed runs to average')
+    parser.add_argument(
+        '-t', '--nthreads', type=int, nargs='+', default=[1, 0],
+        help='Prediction thread counts to time, 0 for all cores')
+    parser.add_argument(
+        '--treelite', action='store_true',
+        help='Also time the compiled Treelite model, and check that it'
+             ' matches XGBoost')
+    parser.add_argument(
+        'input_filename',
+        help='Granule to predict')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Benchmark training on each device
+
+The features of a synthetic granule are quantized and fit once per
+device and thread count, the same way train.py does it. Each result is
+written as a JSON line, like benchmark.py. The device that XGBoost
+actually used is recorded too, since it falls back to the CPU when there
+is no GPU.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import xgboost as xgb
+import benchmark
+import features
+import profiling
+import synthetic
+import train
+
+
+def get_training_data(n, seed):
+
+    df = synthetic.get_granule(n, seed)
+    density = features.get_density(df, features.bathy_mask(df))
+    x = features.get_features(df, density)
+    y = features.map_labels(features.get_manual_labels(df))
+    return x, y
+
+
+def run(x, y, device, nthread, rounds):
+
+    # Returns the seconds taken by each stage, and the device used
+    t0 = time.perf_counter()
+    dtrain = train.get_dmatrix(x, y, nthread)
+    t1 = time.perf_counter()
+    booster = xgb.train(train.get_params(device, nthread),
+                        dtrain,
+                        num_boost_round=rounds)
+    t2 = time.perf_counter()
+    seconds = {'quantize': t1 - t0, 'fit': t2 - t1}
+    return seconds, train.get_device(booster)
+
+
+def main(args):
+
+    # Show args
+    if args.verbose:
+        print(args, file=sys.stderr)
+
+    n = int(args.size)
+    x, y = get_training_data(n, args.seed)
+
+    # Common fields of every result
+    common = {
+        'commit': benchmark.get_commit(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'xgboost': xgb.__version__,
+        'cpus': os.cpu_count(),
+        'seed': args.seed,
+        'rows': n,
+        'rounds': args.rounds,
+        'repeat': args.repeat,
+        }
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+    for device in args.devices:
+        for nthread in args.nthreads:
+
+            if args.verbose:
+                print(f'Benchmarking {device} with {nthread} threads',
+                      file=sys.stderr)
+
+            # Keep the fastest of the repeats
+            best = {}
+            for _ in range(args.repeat):
+                seconds, used = run(x, y, device, nthread, args.rounds)
+                for stage, s in seconds.items():
+                    best[stage] = min(s, best.get(stage, s))
+
+            for stage, s in best.items():
+                result = dict(common,
+                              stage=stage,
+                              device=device,
+                              device_used=used,
+                              nthread=nthread,
+                              seconds=round(s, 6),
+                              rows_per_sec=round(n / s),
+                              process_peak_rss_mb=round(
+                                  profiling.get_peak_rss() / (1 << 20), 1))
+                print(json.dumps(result), file=output, flush=True)
+
+    if output is not sys.stdout:
+        output.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Training benchmark on each device')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Show verbose output')
+    parser.add_argument(
+        '-d', '--devices', nargs='+', default=train.DEVICES,
+        choices=train.DEVICES,
+        help='Training devices to benchmark')
+    parser.add_argument(
+        '-t', '--nthreads', type=int, nargs='+', default=[0],
+        help='Training thread counts to benchmark, 0 for all cores')
+    parser.add_argument(
+        '-n', '--size', type=float, default=1e6,
+        help='Number of training photons')
+    parser.add_argument(
+        '-e', '--rounds', type=int, default=train.N_ESTIMATORS,
+        help='Number of boosting rounds')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='Number of runs of each device, keeping the fastest')
+    parser.add_argument(
+        '-s', '--seed', type=int, default=0,
+        help='Random seed')
+    parser.add_argument(
+        '-o', '--output',
+        help='Append results to this file instead of printing them')
+
+    args = parser.parse_args()
+
+    main(args)
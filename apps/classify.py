@@ -1,24 +1,96 @@
 import argparse
+import glob
+import numpy as np
+import os
 import pandas as pd
 import sys
-import xgboost as xgb
-from sklearn.metrics import classification_report
-from sklearn.metrics import f1_score
-from sklearn.metrics import balanced_accuracy_score
-from sklearn.neighbors import LocalOutlierFactor
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+import compiled_model
+import feature_cache
+import features
+import fileutil
+import model_registry
+import photon_io
+import profiling
 
 # Turn off SettingWithCopyWarning
 pd.options.mode.chained_assignment = None  # default='warn'
 
+# Columns read from each granule
+INPUT_COLUMNS = ['index_ph'] + features.INPUT_COLUMNS
 
-def classify(df, verbose, model_filename):
+# Approximate working memory per photon row when streaming, and per
+# bathy candidate photon in a density window
+STREAM_ROW_BYTES = 2048
+STREAM_CANDIDATE_BYTES = 2048
+
+# Memory held back from the chunks for reader buffers and thread pools
+STREAM_RESERVE_BYTES = 64 << 20
+
+# Largest streamed chunk. Bigger chunks do not read any faster.
+STREAM_MAX_CHUNK_ROWS = 1 << 22
+
+# Streamed granules size their chunks to the memory left in the whole
+# process, so serve threads stream one granule at a time
+STREAM_LOCK = threading.Lock()
+
+# Output file extensions
+OUTPUT_EXTENSIONS = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'feather': '.feather',
+    }
+
+
+# Boosters and compiled models loaded by this process
+MODELS = model_registry.ModelRegistry()
+COMPILED_MODELS = model_registry.ModelRegistry(
+    loader=compiled_model.CompiledModel)
+
+
+def load_model(model_filename, nthread=0, backend='xgboost'):
+
+    # Each model is only read once per process, and again if it is
+    # replaced on disk. An nthread of 0 uses all cores.
+    if backend == 'treelite':
+        return COMPILED_MODELS.get(model_filename, nthread)
+
+    return MODELS.get(model_filename, nthread)
+
+
+def predict(clf, x):
+
+    # One call for both the classes and the bathy probabilities, without
+    # building a DMatrix
+    if isinstance(clf, compiled_model.CompiledModel):
+        probs = clf.predict_proba(x)
+    else:
+        probs = clf.inplace_predict(x)
+    return np.argmax(probs, axis=1), probs[:, 1]
+
+
+def classify(df,
+             verbose,
+             model_filename,
+             density=None,
+             nthread=0,
+             backend='xgboost',
+             stats=None):
+
+    if stats is None:
+        stats = profiling.Stats()
 
     # Add a manual label column if one does not exist
     if 'manual_label' not in df.columns:
         df['manual_label'] = 0
 
     # Make sure manual label is an int
-    df['manual_label'] = df['manual_label'].astype(int)
+    df['manual_label'] = df['manual_label'].astype(
+        photon_io.PHOTON_DTYPES['manual_label'])
 
     # Save photon indexes
     index_ph = df['index_ph']
@@ -26,70 +98,34 @@ def classify(df, verbose, model_filename):
     # Save along track distance
     x_atc = df['x_atc']
 
-    # Get indexes of points marked as bathy
-    indexes = df.index[(df['qtrees'] == 40) |
-                       (df['cshelph'] == 40) |
-                       (df['medianfilter'] == 40) |
-                       (df['bathypathfinder'] == 40) |
-                       (df['openoceanspp'] == 40) |
-                       (df['coastnet'] == 40)]
-
-    # Get a list of photons that contain at least one bathy prediction
-    p = df[['x_atc', 'geoid_corr_h']].copy().to_numpy()[indexes]
-
-    # Apply aspect ratio
-    aspect_ratio = 10
-    p[0, :] /= aspect_ratio
-
-    # Compute Local Outlier Factor
-    n_neighbors = 16
-    lof = LocalOutlierFactor(n_neighbors=n_neighbors)
-    lof.fit(p)
-
-    # Get densities of bathy photons
-    density = lof.negative_outlier_factor_
-
-    # Keep only the columns we need
-    df = df[['geoid_corr_h',
-             'surface_h',
-             'qtrees',
-             'cshelph',
-             'medianfilter',
-             'bathypathfinder',
-             'openoceanspp',
-             'coastnet',
-             'manual_label']]
-
-    # Add the density
-    df.loc[:, 'density'] = density.max()
-    df.loc[indexes, 'density'] = density
+    # Get the features
+    if density is None:
+        with stats.stage('mask', len(df.index)):
+            mask = features.bathy_mask(df)
+        with stats.stage('lof', mask.sum()):
+            density = features.get_density(df, mask)
+    with stats.stage('features', len(df.index)):
+        x = features.get_features(df, density)
+        y = features.get_labels(df)
 
     if verbose:
-        print(df.describe(), file=sys.stderr)
-
-    x = df.drop('manual_label', axis=1).to_numpy()
-    y = df.manual_label.copy().to_numpy()
+        print(pd.DataFrame(x, columns=features.FEATURES).describe(),
+              file=sys.stderr)
 
-    # Replace 'unknown' with 'unclassified'
-    y[y == 1] = 0
-
-    # Replace 'water column' with 'unclassified'
-    y[y == 45] = 0
-
-    # Make labels consecutive
-    y[y == 40] = 1
-    y[y == 41] = 2
-
-    clf = xgb.XGBClassifier(device='cpu')
-    clf.load_model(model_filename)
+    clf = load_model(model_filename, nthread, backend)
 
     if verbose:
         print('Predicting...', file=sys.stderr)
 
-    p = clf.predict(x)
-    q = clf.predict_proba(x)[:, 1]
+    with stats.stage('predict', len(x)):
+        p, q = predict(clf, x)
 
     if verbose:
+        # sklearn is slow to import, and only needed here
+        from sklearn.metrics import classification_report
+        from sklearn.metrics import f1_score
+        from sklearn.metrics import balanced_accuracy_score
+
         r = classification_report(y, p, digits=3)
         f1 = f1_score(y, p, average='weighted')
         ba = balanced_accuracy_score(y, p)
@@ -98,19 +134,25 @@ def classify(df, verbose, model_filename):
         print(f'Weighted F1\t{f1:.3f}', file=sys.stderr)
         print(f'Balanced accuracy\t{ba:.3f}', file=sys.stderr)
 
-    # Add back x_atc column for viewing
-    df.loc[:, "x_atc"] = x_atc
-
     # Change predictions back to ASPRS
     p[p == 1] = 40
     p[p == 2] = 41
 
+    # Keep only the columns we need, and add the predictions
+    columns = ['geoid_corr_h', 'surface_h'] + features.ALGORITHMS
+    columns += ['manual_label']
+    df = pd.DataFrame({c: df[c] for c in columns})
+    df['density'] = density.astype(photon_io.PHOTON_DTYPES['density'])
+
+    # Add back x_atc column for viewing
+    df['x_atc'] = x_atc
+
     # Assign predictions
-    df.loc[:, "ensemble"] = p
-    df.loc[:, "ensemble_bathy_prob"] = q
+    df['ensemble'] = p.astype(photon_io.PHOTON_DTYPES['ensemble'])
+    df['ensemble_bathy_prob'] = q
 
     # Add the indexes
-    df.loc[:, "index_ph"] = index_ph
+    df['index_ph'] = index_ph
 
     if verbose:
         print(df.describe(), file=sys.stderr)
@@ -118,22 +160,390 @@ def classify(df, verbose, model_filename):
     return df
 
 
+def classify_stream(input_filename,
+                    output_filename,
+                    model_filename,
+                    verbose,
+                    max_memory,
+                    nthread=0,
+                    backend='xgboost',
+                    stats=None):
+
+    if stats is None:
+        stats = profiling.Stats()
+
+    # Size the chunks to fit in what is left of the memory cap once the
+    # model is loaded
+    load_model(model_filename, nthread, backend)
+    budget = max_memory - profiling.get_rss() - STREAM_RESERVE_BYTES
+    if budget <= 0:
+        raise MemoryError(f'Memory cap of {max_memory >> 20} MB is'
+                          f' already used before reading {input_filename}')
+    chunk_rows = min(max(1, budget // STREAM_ROW_BYTES),
+                     STREAM_MAX_CHUNK_ROWS)
+    window = max(1, budget // STREAM_CANDIDATE_BYTES)
+
+    if verbose:
+        print(f'Streaming {input_filename} in chunks of {chunk_rows} rows',
+              file=sys.stderr)
+
+    # First pass: collect the bathy candidate photons. The densities of
+    # all candidates are needed before any chunk can be predicted, since
+    # the other photons get the maximum density over the whole granule.
+    columns = ['x_atc', 'geoid_corr_h'] + features.ALGORITHMS
+    with stats.stage('candidates') as record:
+        candidates = []
+        for d in photon_io.iter_photons(input_filename, columns, chunk_rows):
+            mask = features.bathy_mask(d)
+            candidates.append(features.get_candidates(d, mask))
+        p = np.concatenate(candidates)
+        del candidates
+        record['rows'] = len(p)
+
+    # Compute densities in along track windows
+    with stats.stage('lof', len(p)):
+        candidate_density = features.get_candidate_density(p, window)
+        fill = candidate_density.max()
+        del p
+
+    # Second pass: predict each chunk and append it to the output. A
+    # granule that fails leaves no partial output.
+    n = 0
+    ext = os.path.splitext(output_filename)[1]
+    with (stats.stage('classify') as record,
+          fileutil.atomic_write(output_filename, suffix='.tmp' + ext) as tmp,
+          photon_io.PhotonWriter(tmp) as writer):
+        for df in photon_io.iter_photons(input_filename,
+                                         INPUT_COLUMNS,
+                                         chunk_rows):
+            mask = features.bathy_mask(df)
+            density = np.full(len(mask), fill)
+            density[mask] = candidate_density[n:n + mask.sum()]
+            n += mask.sum()
+
+            writer.write(classify(df,
+                                  False,
+                                  model_filename,
+                                  density,
+                                  nthread,
+                                  backend))
+
+            if profiling.get_rss() > max_memory:
+                raise MemoryError(f'Memory cap of {max_memory >> 20} MB'
+                                  f' exceeded classifying {input_filename}')
+
+        record['rows'] = writer.rows
+
+    return writer.rows
+
+
+def classify_file(input_filename,
+                  output_filename,
+                  model_filename,
+                  verbose,
+                  max_memory=None,
+                  cache=None,
+                  nthread=0,
+                  backend='xgboost',
+                  stats=None):
+
+    if stats is None:
+        stats = profiling.Stats()
+
+    # Stream granules when there is a memory cap. Streamed granules are
+    # not cached, since that needs the whole density column in memory.
+    if max_memory is not None:
+        with STREAM_LOCK:
+            return classify_stream(input_filename,
+                                   output_filename,
+                                   model_filename,
+                                   verbose,
+                                   max_memory,
+                                   nthread,
+                                   backend,
+                                   stats)
+
+    # Get the dataframe
+    with stats.stage('read') as record:
+        df = photon_io.read_photons(input_filename, INPUT_COLUMNS)
+        record['rows'] = len(df.index)
+
+    # Get cached densities
+    density = None
+    if cache is not None:
+        with stats.stage('density', len(df.index)):
+            _, _, density = feature_cache.get_granule_features(
+                cache, input_filename, df)
+
+    # Get predictions
+    df = classify(df,
+                  verbose,
+                  model_filename,
+                  density,
+                  nthread,
+                  backend,
+                  stats)
+
+    # Save results
+    ext = os.path.splitext(output_filename)[1]
+    with (stats.stage('write', len(df.index)),
+          fileutil.atomic_write(output_filename, suffix='.tmp' + ext) as tmp):
+        photon_io.write_photons(df, tmp)
+
+    return len(df.index)
+
+
+def get_cache(args):
+
+    # Looking up a granule hashes the whole file, so classify only uses
+    # the cache when asked to
+    if not (args.cache or args.write_cache):
+        return None
+    return feature_cache.FeatureCache(args.cache_dir,
+                                      args.cache_max_gb,
+                                      read_only=not args.write_cache)
+
+
+def get_output_filename(input_filename, output_dir, output_format):
+
+    # Same naming as the Makefile: <output_dir>/<name>_classified.csv
+    name = os.path.splitext(os.path.basename(input_filename))[0]
+    ext = OUTPUT_EXTENSIONS[output_format]
+    return os.path.join(output_dir, f'{name}_classified{ext}')
+
+
+def serve(args):
+
+    # Load the model before accepting any requests
+    load_model(args.model_filename, args.nthread, args.backend)
+    cache = get_cache(args)
+    stats = profiling.get_stats(args, 'classify')
+
+    if args.verbose:
+        print(f'Serving with {args.jobs} workers', file=sys.stderr)
+
+    lock = threading.Lock()
+    latencies = []
+
+    def run(input_filename, output_filename, model_filename, received):
+        try:
+            rows = classify_file(input_filename,
+                                 output_filename,
+                                 model_filename,
+                                 args.verbose,
+                                 args.max_memory,
+                                 cache,
+                                 args.nthread,
+                                 args.backend,
+                                 stats.with_fields(input=input_filename))
+            status = 'ok'
+        except Exception as e:
+            rows = 0
+            status = f'error: {e}'.replace('\t', ' ').replace('\n', ' ')
+        latency = time.perf_counter() - received
+
+        # Report each request as soon as it finishes
+        with lock:
+            latencies.append(latency)
+            print(f'{status}'
+                  f'\t{input_filename}'
+                  f'\t{output_filename}'
+                  f'\t{rows}'
+                  f'\t{latency:0.3f}',
+                  flush=True)
+
+    # Each line on stdin is a request: an input filename, and optionally
+    # a tab separated output filename and model. The model can be a
+    # filename, a date or 'latest', and defaults to --model-filename.
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            received = time.perf_counter()
+            fields = line.split('\t')
+            input_filename = fields[0]
+            if len(fields) > 1:
+                output_filename = fields[1]
+            else:
+                output_filename = get_output_filename(input_filename,
+                                                      args.output_dir,
+                                                      args.output_format)
+            if len(fields) > 2:
+                model_filename = fields[2]
+            else:
+                model_filename = args.model_filename
+            pool.submit(run,
+                        input_filename,
+                        output_filename,
+                        model_filename,
+                        received)
+
+    if args.verbose and latencies:
+        s = pd.Series(latencies)
+        print(f'{len(s)} requests, latency'
+              f' mean {s.mean():0.3f}s,'
+              f' median {s.median():0.3f}s,'
+              f' max {s.max():0.3f}s',
+              file=sys.stderr)
+
+
+def get_input_filenames(specs):
+
+    # Expand globs, keeping unmatched names so that they fail visibly
+    filenames = []
+    for spec in specs:
+        matches = sorted(glob.glob(spec))
+        filenames += matches if matches else [spec]
+    return filenames
+
+
+def init_worker(model_filename, nthread, backend):
+
+    # Load the model once per worker process
+    load_model(model_filename, nthread, backend)
+
+
+def classify_worker(input_filename,
+                    output_filename,
+                    model_filename,
+                    verbose,
+                    max_memory,
+                    cache,
+                    nthread,
+                    backend,
+                    stats):
+
+    start = time.perf_counter()
+    try:
+        rows = classify_file(input_filename,
+                             output_filename,
+                             model_filename,
+                             verbose,
+                             max_memory,
+                             cache,
+                             nthread,
+                             backend,
+                             stats.with_fields(input=input_filename))
+        error = None
+    except Exception as e:
+        rows = 0
+        error = str(e)
+
+    return os.getpid(), rows, time.perf_counter() - start, error
+
+
+def classify_files(filenames, args):
+
+    # Per worker totals: files, failures, rows, seconds
+    workers = {}
+    failures = 0
+
+    cache = get_cache(args)
+    stats = profiling.get_stats(args, 'classify')
+
+    # Compile the model before starting the workers, so that they do
+    # not all compile it at once
+    if args.backend == 'treelite':
+        compiled_model.compile_model(args.model_filename, args.verbose)
+
+    with ProcessPoolExecutor(max_workers=args.jobs,
+                             initializer=init_worker,
+                             initargs=(args.model_filename,
+                                       args.nthread,
+                                       args.backend)) as pool:
+        futures = {}
+        for fn in filenames:
+            output_filename = get_output_filename(fn,
+                                                  args.output_dir,
+                                                  args.output_format)
+            f = pool.submit(classify_worker,
+                            fn,
+                            output_filename,
+                            args.model_filename,
+                            args.verbose,
+                            args.max_memory,
+                            cache,
+                            args.nthread,
+                            args.backend,
+                            stats)
+            futures[f] = fn
+
+        for n, f in enumerate(as_completed(futures)):
+            fn = futures[f]
+            pid, rows, seconds, error = f.result()
+            totals = workers.setdefault(pid, [0, 0, 0, 0.0])
+            totals[0] += 1
+            totals[2] += rows
+            totals[3] += seconds
+
+            # A failed granule does not stop the others
+            if error is not None:
+                totals[1] += 1
+                failures += 1
+                print(f'Failed {fn}: {error}', file=sys.stderr)
+            elif args.verbose:
+                print(f'Classified {n + 1} of {len(filenames)}: {fn}',
+                      file=sys.stderr)
+
+    # Show throughput summary
+    print(f'Worker'
+          f'\tFiles'
+          f'\tFailed'
+          f'\tRows'
+          f'\tSeconds'
+          f'\tRows/sec',
+          file=sys.stderr)
+    for pid, (files, failed, rows, seconds) in sorted(workers.items()):
+        rate = rows / seconds if seconds > 0 else 0.0
+        print(f'{pid}'
+              f'\t{files}'
+              f'\t{failed}'
+              f'\t{rows}'
+              f'\t{seconds:0.3f}'
+              f'\t{rate:0.0f}',
+              file=sys.stderr)
+
+    return failures
+
+
 def main(args):
 
+    # Pin 'latest' or a date to one model file for the whole run
+    args.model_filename = MODELS.resolve(args.model_filename)
+
+    if args.serve:
+        serve(args)
+        return
+
+    filenames = get_input_filenames(args.input_filenames)
+
     # Show args
     if args.verbose:
-        print('input_filename:', args.input_filename, file=sys.stderr)
+        print('input_filenames:', filenames, file=sys.stderr)
         print('model_filename:', args.model_filename, file=sys.stderr)
         print('output_filename:', args.output_filename, file=sys.stderr)
+        print('output_dir:', args.output_dir, file=sys.stderr)
 
-    # Get the dataframe
-    df = pd.read_csv(args.input_filename, engine='pyarrow')
+    # A single granule is classified in this process
+    if args.output_filename is not None:
+        classify_file(filenames[0],
+                      args.output_filename,
+                      args.model_filename,
+                      args.verbose,
+                      args.max_memory,
+                      get_cache(args),
+                      args.nthread,
+                      args.backend,
+                      profiling.get_stats(args, 'classify').with_fields(
+                          input=filenames[0]))
+        return
 
-    # Get predictions
-    df = classify(df, args.verbose, args.model_filename)
+    failures = classify_files(filenames, args)
 
-    # Save results
-    df.to_csv(args.output_filename, index=False, float_format='%.7f')
+    if failures:
+        print(f'{failures} of {len(filenames)} files failed', file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -145,14 +555,72 @@ if __name__ == "__main__":
         '-v', '--verbose', action='store_true',
         help="Show verbose output")
     parser.add_argument(
-        'input_filename',
-        help="Input filename specification")
+        'input_filenames', nargs='*',
+        help="Input filenames or globs")
     parser.add_argument(
-        '-m', '--model-filename',
-        help="Model filename specification")
+        '-m', '--model-filename', default='latest',
+        help="Model filename, date (YYYYMMDD) or 'latest'")
     parser.add_argument(
         '-o', '--output-filename',
-        help="Output filename specification")
+        help="Output filename for a single input file")
+    parser.add_argument(
+        '-s', '--serve', action='store_true',
+        help="Classify input filenames read from stdin, one per line")
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count(),
+        help="Number of worker processes, or concurrent requests"
+             " when serving")
+    parser.add_argument(
+        '-d', '--output-dir', default='.',
+        help="Output directory for multiple input files, or when serving")
+    parser.add_argument(
+        '-f', '--output-format', default='csv',
+        choices=OUTPUT_EXTENSIONS.keys(),
+        help="Output format when writing to the output directory")
+    parser.add_argument(
+        '-t', '--nthread', type=int, default=0,
+        help="Number of prediction threads per process, 0 for all cores")
+    parser.add_argument(
+        '-b', '--backend', default='xgboost',
+        choices=['xgboost', 'treelite'],
+        help="Prediction backend. treelite compiles the model to a shared"
+             " library next to the model file on first use.")
+    parser.add_argument(
+        '--max-memory', type=int,
+        help="Stream each granule in chunks, keeping the peak memory of"
+             " each process under this many MB. With --serve, granules"
+             " are streamed one at a time.")
+    parser.add_argument(
+        '--stats',
+        help="Append per stage timings as JSON lines to this file, or"
+             " '-' for stderr")
+    parser.add_argument(
+        '--profile',
+        help="Write a cProfile dump of the main process to this file, or a"
+             " pyinstrument report if it ends in .html")
+    parser.add_argument(
+        '--cache-dir', default=feature_cache.DEFAULT_CACHE_DIR,
+        help="Directory for cached granule features")
+    parser.add_argument(
+        '--cache-max-gb', type=float, default=feature_cache.DEFAULT_MAX_GB,
+        help="Size limit of the feature cache")
+    parser.add_argument(
+        '--cache', action='store_true',
+        help="Read densities from the feature cache")
+    parser.add_argument(
+        '--write-cache', action='store_true',
+        help="Read densities from the feature cache, and add the features"
+             " of uncached granules to it")
     args = parser.parse_args()
 
-    main(args)
+    if args.max_memory is not None:
+        args.max_memory <<= 20
+
+    if not args.serve and not args.input_filenames:
+        parser.error('input filenames are required unless serving')
+    if args.output_filename is not None and len(
+            get_input_filenames(args.input_filenames)) != 1:
+        parser.error('--output-filename requires a single input file')
+
+    with profiling.profile(args.profile):
+        main(args)
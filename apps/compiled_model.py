@@ -0,0 +1,81 @@
+"""
+ATL24 track stacker compiled tree models
+
+The XGBoost models are small, fixed depth tree ensembles, so compiling
+them to native code with Treelite is much faster on CPU than generic
+XGBoost prediction. Each model is compiled once into a shared library
+next to its JSON file, and recompiled only when the JSON is newer.
+
+treelite and tl2cgen are optional, and are only imported when a
+compiled model is used.
+"""
+
+import os
+import sys
+import fileutil
+import model_registry
+
+# Largest absolute difference from the XGBoost probabilities that is
+# expected from compiled prediction
+PARITY_ATOL = 1e-5
+
+
+def get_library_filename(model_filename):
+
+    # model-YYYYMMDD.json -> model-YYYYMMDD.so
+    return os.path.splitext(model_filename)[0] + '.so'
+
+
+def is_current(model_filename, library_filename):
+
+    try:
+        return (os.path.getmtime(library_filename) >=
+                os.path.getmtime(model_filename))
+    except OSError:
+        return False
+
+
+def compile_model(model_filename, verbose=False):
+
+    # Returns the shared library, compiling it if it is missing or stale
+    library_filename = get_library_filename(model_filename)
+    if is_current(model_filename, library_filename):
+        return library_filename
+
+    import treelite
+    import tl2cgen
+
+    if verbose:
+        print(f'Compiling {model_filename} to {library_filename}',
+              file=sys.stderr)
+
+    # Compile from the checked model contents
+    booster = model_registry.load_booster(model_filename)
+    model = treelite.frontend.from_xgboost(booster)
+
+    with fileutil.atomic_write(library_filename,
+                               suffix='.tmp.so',
+                               mode=0o777) as tmp:
+        tl2cgen.export_lib(model,
+                           toolchain='gcc',
+                           libpath=tmp,
+                           params={'parallel_comp': os.cpu_count()})
+
+    return library_filename
+
+
+class CompiledModel:
+
+    def __init__(self, model_filename, nthread=0):
+        import tl2cgen
+        self.tl2cgen = tl2cgen
+        library_filename = compile_model(model_filename)
+        self.predictor = tl2cgen.Predictor(library_filename,
+                                           nthread=nthread or None)
+
+    def predict_proba(self, x):
+
+        # Class probabilities, one row per photon
+        dmat = self.tl2cgen.DMatrix(x, dtype='float32')
+        probs = self.predictor.predict(dmat)
+        return probs.reshape(len(x), -1)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+ATL24 track stacker cross validation
+
+Load the features of every granule once, then train, classify and score
+each fold in this process. Granules are assigned to folds the same way
+as generate_cross_val_commands.py, and the scores are written to the
+same cross_val.all.N.txt and cross_val.binary.N.txt files.
+"""
+
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import sys
+import numpy as np
+import pandas as pd
+import feature_cache
+import features
+import photon_io
+import profiling
+import score
+import train
+from concurrent.futures import ProcessPoolExecutor
+
+# Features, manual labels, fold and granule of every photon, and the
+# granule filenames. This is a global so that forked fold workers share
+# it instead of copying it.
+DATA = None
+
+
+def get_folds(rows, splits):
+
+    # Granule n is in fold n % splits, as in generate_cross_val_commands.py
+    granule_folds = np.arange(len(rows)) % splits
+    return np.repeat(granule_folds, rows)
+
+
+def run_fold(split, args):
+
+    x, labels, folds, granules, filenames = DATA
+    test = folds == split
+
+    if args.verbose:
+        print(f'Fold {split}: training on {np.count_nonzero(~test)} rows,'
+              f' testing on {np.count_nonzero(test)} rows',
+              file=sys.stderr)
+
+    # Hold out granules of the other folds for early stopping, the same
+    # way as train.py
+    training = np.unique(granules[~test])
+    held_out = np.zeros(len(filenames), dtype=bool)
+    held_out[training] = train.split_granules(
+        [filenames[n] for n in training], args.validation_fraction)
+
+    # Train on the other folds
+    dtrain, dval = train.get_split_dmatrices(
+        x[~test],
+        features.map_labels(labels[~test]),
+        held_out[granules[~test]],
+        args.nthread)
+    booster = train.fit(dtrain, dval, args, profiling.Stats())
+    del dtrain, dval
+
+    # Predict this fold, and change predictions back to ASPRS
+    p = booster.inplace_predict(x[test]).argmax(axis=1)
+    p[p == 1] = 40
+    p[p == 2] = 41
+
+    # Same columns as the classified granules read by score.py
+    df = pd.DataFrame({'manual_label': labels[test]})
+    for a in score.ALGORITHMS:
+        if a == 'ensemble':
+            df[a] = p
+        else:
+            df[a] = x[test, features.FEATURES.index(a)].astype(np.int64)
+
+    # Score it
+    results = []
+    for all_classes in [True, False]:
+        with contextlib.redirect_stdout(io.StringIO()) as f:
+            score.score(df, score.ALGORITHMS, all_classes, args.verbose)
+        results.append(f.getvalue())
+
+    return results
+
+
+def main(args):
+
+    global DATA
+
+    # Show args
+    if args.verbose:
+        print(args, file=sys.stderr)
+
+    # Get the filenames
+    filenames = photon_io.glob_photons(args.input_glob, args.store)
+    print(f'{len(filenames)} total files', file=sys.stderr)
+
+    # Fail on a bad output directory before the slow extraction
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # Extract features from each granule, once
+    x, labels, rows = train.get_training_data(filenames, args)
+    granules = np.repeat(np.arange(len(rows)), rows)
+    DATA = (x, labels, get_folds(rows, args.splits), granules, filenames)
+
+    # Train, classify and score each fold
+    splits = range(args.splits)
+    fold_args = [args] * args.splits
+    if args.fold_jobs > 1:
+        ctx = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=args.fold_jobs,
+                                 mp_context=ctx) as pool:
+            results = list(pool.map(run_fold, splits, fold_args))
+    else:
+        results = list(map(run_fold, splits, fold_args))
+
+    # Save the scores
+    for split, (scores_all, scores_binary) in zip(splits, results):
+        fn = os.path.join(args.output_dir, f'cross_val.all.{split}.txt')
+        with open(fn, 'w') as f:
+            f.write(scores_all)
+        fn = os.path.join(args.output_dir, f'cross_val.binary.{split}.txt')
+        with open(fn, 'w') as f:
+            f.write(scores_binary)
+        if args.verbose:
+            print(scores_binary, file=sys.stderr)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Cross validate the track stacker')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Show verbose output')
+    parser.add_argument(
+        '-s', '--splits', type=int, default=5,
+        help='Number of cross-val splits')
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of granules to extract in parallel')
+    parser.add_argument(
+        '-f', '--fold-jobs',
+        type=int,
+        default=1,
+        help='Number of folds to run in parallel')
+    train.add_fit_arguments(parser)
+    parser.add_argument(
+        '--store',
+        type=str,
+        help='Read granules from this photon store, matching the glob'
+             ' against granule names')
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=photon_io.PREFETCH_DEPTH,
+        help='Number of granules to read ahead with --jobs=1')
+    parser.add_argument(
+        '-o', '--output-dir',
+        type=str,
+        default='.',
+        help='Directory for the cross_val.*.N.txt files')
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        default=feature_cache.DEFAULT_CACHE_DIR,
+        help='Directory for cached granule features')
+    parser.add_argument(
+        '--cache-max-gb',
+        type=float,
+        default=feature_cache.DEFAULT_MAX_GB,
+        help='Size limit of the feature cache')
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='Do not read or write cached features')
+    parser.add_argument(
+        'input_glob',
+        type=str,
+        help='Input filename glob')
+
+    args = parser.parse_args()
+
+    main(args)
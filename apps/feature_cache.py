@@ -0,0 +1,136 @@
+"""
+ATL24 track stacker feature cache
+
+Features are expensive to compute, mostly because of the photon
+density, and the same granules are used over and over by training,
+classification and cross validation. This caches the features of each
+granule on disk, keyed by a hash of the granule's contents and the
+feature pipeline version. The least recently used entries are evicted
+when the cache grows past its size limit. classify.py only uses the
+cache when it is asked to, since one-off runs rarely see the same
+granule again.
+"""
+
+import hashlib
+import os
+import numpy as np
+import features
+import fileutil
+import photon_io
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'),
+                                 '.cache',
+                                 'atl24_track_stacker',
+                                 'features')
+DEFAULT_MAX_GB = 20.0
+
+# Bytes read at a time when hashing a granule
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def get_key(filename):
+
+    h = hashlib.sha256()
+    h.update(f'features-v{features.FEATURE_VERSION}\n'.encode())
+    for b in photon_io.iter_blocks(filename, HASH_BLOCK_SIZE):
+        h.update(b)
+    return h.hexdigest()
+
+
+class FeatureCache:
+
+    def __init__(self,
+                 cache_dir=DEFAULT_CACHE_DIR,
+                 max_gb=DEFAULT_MAX_GB,
+                 read_only=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_gb * (1 << 30))
+        self.read_only = read_only
+        if not read_only:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def get(self, key):
+
+        # Returns features, manual labels and densities, or None on a miss
+        path = self.get_path(key)
+        try:
+            with np.load(path) as f:
+                entry = f['x'], f['manual_label'], f['density']
+        except (OSError, KeyError, ValueError):
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return entry
+
+    def put(self, key, x, manual_label, density):
+
+        if self.read_only:
+            return
+
+        with fileutil.atomic_write(self.get_path(key)) as tmp:
+            with open(tmp, 'wb') as f:
+                np.savez(f, x=x, manual_label=manual_label, density=density)
+
+        self.evict()
+
+    def evict(self):
+
+        # Remove least recently used entries until under the limit
+        entries = []
+        for e in os.scandir(self.cache_dir):
+            if e.name.endswith('.npz'):
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def get_cache(args):
+
+    # Build a cache from command line arguments
+    if args.no_cache:
+        return None
+    return FeatureCache(args.cache_dir, args.cache_max_gb)
+
+
+def get_granule_features(cache, filename, df=None):
+
+    # Get features, ASPRS manual labels and densities for a granule,
+    # from the cache when possible. The granule is only read on a miss,
+    # unless the caller already has it.
+    if cache is not None:
+        key = get_key(filename)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+
+    if df is None:
+        df = photon_io.read_photons(filename, features.INPUT_COLUMNS)
+
+    density = features.get_density(df, features.bathy_mask(df))
+    x = features.get_features(df, density)
+    manual_label = features.get_manual_labels(df)
+
+    if cache is not None:
+        cache.put(key, x, manual_label, density)
+
+    return x, manual_label, density
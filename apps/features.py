@@ -0,0 +1,127 @@
+"""
+ATL24 track stacker feature extraction
+
+Shared by train.py and classify.py so that both apps build exactly the
+same feature matrix from a granule.
+"""
+
+import numpy as np
+import lof
+
+# Algorithm label columns, in the order the model expects them
+ALGORITHMS = [
+    'qtrees',
+    'cshelph',
+    'medianfilter',
+    'bathypathfinder',
+    'openoceanspp',
+    'coastnet',
+    ]
+
+# Columns read from each granule
+INPUT_COLUMNS = [
+    'x_atc',
+    'geoid_corr_h',
+    'surface_h',
+    ] + ALGORITHMS + ['manual_label']
+
+# Model feature columns, in order
+FEATURES = ['geoid_corr_h', 'surface_h'] + ALGORITHMS + ['density']
+FEATURE_TYPES = ['float', 'float'] + ['int'] * len(ALGORITHMS) + ['float']
+
+# Bump this whenever a change to this module changes the features, so
+# that cached features are recomputed
+FEATURE_VERSION = 3
+
+# ASPRS bathy label
+BATHY = 40
+
+# Density parameters
+ASPECT_RATIO = 10
+N_NEIGHBORS = 16
+
+
+def bathy_mask(df):
+
+    # True where at least one algorithm marked the photon as bathy
+    labels = np.column_stack([df[a].to_numpy() for a in ALGORITHMS])
+    return (labels == BATHY).any(axis=1)
+
+
+def get_candidates(df, mask):
+
+    # Get a list of photons that contain at least one bathy prediction
+    return np.column_stack([
+        df['x_atc'].to_numpy(dtype=np.float64)[mask],
+        df['geoid_corr_h'].to_numpy(dtype=np.float64)[mask]])
+
+
+def get_candidate_density(p, window=None):
+
+    # Apply aspect ratio
+    #
+    # Note that this scales the first candidate photon rather than the
+    # x_atc column. The released models were trained this way, so it
+    # is kept as is.
+    p[0, :] /= ASPECT_RATIO
+
+    # Get densities of bathy photons from their Local Outlier Factor
+    return lof.negative_outlier_factor(p, N_NEIGHBORS, window=window)
+
+
+def get_density(df, mask):
+
+    d = get_candidate_density(get_candidates(df, mask))
+
+    # Photons that are not bathy candidates get the maximum density
+    result = np.full(len(mask), d.max())
+    result[mask] = d
+
+    return result
+
+
+def get_features(df, density=None):
+
+    # Compute the density if the caller does not already have it
+    if density is None:
+        density = get_density(df, bathy_mask(df))
+
+    # Fill a contiguous matrix in model column order
+    x = np.empty((len(density), len(FEATURES)), dtype=np.float32)
+    for n, col in enumerate(FEATURES[:-1]):
+        x[:, n] = df[col].to_numpy()
+    x[:, -1] = density
+
+    return x
+
+
+def get_manual_labels(df):
+
+    # Unlabeled granules are all 'unclassified'
+    if 'manual_label' not in df.columns:
+        return np.zeros(len(df.index), dtype=np.int64)
+
+    return df['manual_label'].to_numpy(dtype=np.int64, copy=True)
+
+
+def get_labels(df):
+
+    return map_labels(get_manual_labels(df))
+
+
+def map_labels(manual_labels):
+
+    # Map ASPRS manual labels to consecutive model classes
+    y = manual_labels.copy()
+
+    # Replace 'unknown' with 'unclassified'
+    y[y == 1] = 0
+
+    # Replace 'water column' with 'unclassified'
+    y[y == 45] = 0
+
+    # Make labels consecutive
+    y[y == 40] = 1
+    y[y == 41] = 2
+
+    return y
@@ -0,0 +1,44 @@
+"""
+ATL24 track stacker file helpers
+
+Files that other processes read, like models, compiled libraries,
+cached features and converted granules, are written atomically. They
+are written to a temporary file in the same directory, which is then
+moved into place, so a reader sees the old file or the new one, but
+never a partial file.
+"""
+
+import contextlib
+import os
+import tempfile
+
+# The process umask. Setting it is the only way to read it, and it is
+# process wide, so it is only read once, before any threads start.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def get_file_mode(mode=0o666):
+
+    # mkstemp() files can only be read by their owner, so written files
+    # are given the permissions that open() would have given them
+    return mode & ~UMASK
+
+
+@contextlib.contextmanager
+def atomic_write(filename, suffix='.tmp', mode=0o666):
+
+    # Yields a temporary filename to write. It is moved to filename if
+    # the block succeeds, and removed if it fails. Some writers choose
+    # the format by extension, so the suffix can end with one.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+                               suffix=suffix)
+    os.close(fd)
+    try:
+        yield tmp
+        os.chmod(tmp, get_file_mode(mode))
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
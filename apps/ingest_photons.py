@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Convert granule CSVs to a columnar format
+
+Each granule is checked for the columns that the apps read, its old
+column names are renamed, and it is written with the compact photon
+column types. Granules are converted in parallel. A manifest in the
+output directory records the size, mtime and hash of each converted
+granule, so that later runs only convert new or changed granules.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import features
+import fileutil
+import photon_io
+
+MANIFEST_FILENAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+# Columns every granule must have, after renaming. Like classify.py,
+# unlabeled granules get a manual label of 0.
+REQUIRED_COLUMNS = ['index_ph'] + [c for c in features.INPUT_COLUMNS
+                                   if c != 'manual_label']
+
+# Output extension of each format
+OUTPUT_EXTENSIONS = {'parquet': '.parquet', 'feather': '.arrow'}
+
+# Bytes read at a time when hashing a granule
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def get_hash(filename):
+
+    h = hashlib.sha256()
+    for b in photon_io.iter_blocks(filename, HASH_BLOCK_SIZE):
+        h.update(b)
+    return h.hexdigest()
+
+
+def read_manifest(filename):
+
+    # An empty manifest if there is none, or it is from another version
+    try:
+        with open(filename) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+
+    return manifest['granules']
+
+
+def write_manifest(filename, granules):
+
+    manifest = {'version': MANIFEST_VERSION, 'granules': granules}
+    with fileutil.atomic_write(filename) as tmp:
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def is_current(entry, st, output_dir):
+
+    # Unchanged size and mtime, and the output is still there
+    return (entry is not None and
+            entry['size'] == st.st_size and
+            entry['mtime_ns'] == st.st_mtime_ns and
+            os.path.exists(os.path.join(output_dir, entry['output'])))
+
+
+def convert(input_filename, output_filename):
+
+    # Returns the manifest entry of the converted granule
+    st = os.stat(input_filename)
+    sha256 = get_hash(input_filename)
+
+    df = photon_io.rename_columns(photon_io.read_photons(input_filename))
+    missing = [c for c in REQUIRED_COLUMNS if c not in df.columns]
+    if missing:
+        raise ValueError(f'{input_filename} has no {", ".join(missing)}'
+                         f' column')
+
+    if 'manual_label' not in df.columns:
+        df['manual_label'] = 0
+        df['manual_label'] = df['manual_label'].astype(
+            photon_io.PHOTON_DTYPES['manual_label'])
+
+    # Drop old columns that are also present under their new names
+    df = df.drop(columns=[c for c in photon_io.RENAMED_COLUMNS
+                          if c in df.columns])
+
+    ext = os.path.splitext(output_filename)[1]
+    with fileutil.atomic_write(output_filename, suffix='.tmp' + ext) as tmp:
+        photon_io.write_photons(df, tmp)
+
+    return {
+        'output': os.path.basename(output_filename),
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'sha256': sha256,
+        'rows': len(df.index),
+        }
+
+
+def convert_worker(input_filename, output_filename):
+
+    # Errors are reported at the end, after the other granules are done
+    try:
+        return convert(input_filename, output_filename), None
+    except (OSError, ValueError) as e:
+        return None, str(e)
+
+
+def main(args):
+
+    # Show args
+    if args.verbose:
+        print(args, file=sys.stderr)
+
+    filenames = sorted(photon_io.glob_photons(args.input_glob))
+    if not filenames:
+        raise FileNotFoundError(f'No files match {args.input_glob}')
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest_filename = os.path.join(args.output_dir, MANIFEST_FILENAME)
+    granules = {} if args.force else read_manifest(manifest_filename)
+
+    # Output names must not collide
+    ext = OUTPUT_EXTENSIONS[args.format]
+    outputs = {fn: os.path.splitext(os.path.basename(fn))[0] + ext
+               for fn in filenames}
+    if len(set(outputs.values())) != len(outputs):
+        raise ValueError('Granule names must be unique')
+
+    # Size and mtime are checked first. Only granules that changed are
+    # hashed, and a granule whose contents did not change is not
+    # converted again.
+    todo = []
+    for fn in filenames:
+        key = os.path.abspath(fn)
+        entry = granules.get(key)
+        st = os.stat(fn)
+        if entry is not None and entry['output'] != outputs[fn]:
+            entry = None
+        if is_current(entry, st, args.output_dir):
+            continue
+        if (entry is not None and
+                os.path.exists(os.path.join(args.output_dir,
+                                            entry['output'])) and
+                entry['sha256'] == get_hash(fn)):
+            granules[key] = dict(entry,
+                                 size=st.st_size,
+                                 mtime_ns=st.st_mtime_ns)
+            continue
+        todo.append(fn)
+
+    if args.verbose:
+        print(f'Converting {len(todo)} of {len(filenames)} granules',
+              file=sys.stderr)
+
+    output_filenames = [os.path.join(args.output_dir, outputs[fn])
+                        for fn in todo]
+    if args.jobs > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            results = list(pool.map(convert_worker, todo, output_filenames))
+    else:
+        results = [convert_worker(fn, ofn)
+                   for fn, ofn in zip(todo, output_filenames)]
+
+    errors = []
+    for fn, (entry, error) in zip(todo, results):
+        if error is not None:
+            errors.append(error)
+            continue
+        granules[os.path.abspath(fn)] = entry
+        if args.verbose:
+            print(f'Converted {entry["rows"]} rows: {fn}', file=sys.stderr)
+
+    write_manifest(manifest_filename, granules)
+
+    if errors:
+        for e in errors:
+            print(e, file=sys.stderr)
+        print(f'{len(errors)} granules were not converted', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Convert granule CSVs to a columnar format')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Show verbose output')
+    parser.add_argument(
+        '-o', '--output-dir', required=True,
+        help='Directory for the converted granules and the manifest')
+    parser.add_argument(
+        '-f', '--format', default='parquet',
+        choices=OUTPUT_EXTENSIONS.keys(),
+        help='Output format')
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of granules to convert in parallel')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='Convert every granule, ignoring the manifest')
+    parser.add_argument(
+        'input_glob',
+        help='Input granule filename glob')
+
+    args = parser.parse_args()
+
+    main(args)
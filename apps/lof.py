@@ -0,0 +1,152 @@
+"""
+ATL24 track stacker Local Outlier Factor
+
+A k-nearest-neighbor Local Outlier Factor engine for the 2-D bathy
+candidate point sets used by the track stacker.
+
+It computes the same quantity as sklearn's
+LocalOutlierFactor(n_neighbors=k).fit(p).negative_outlier_factor_, but
+builds a single KD-tree over the points, runs the neighbor queries on
+all cores, and works through the points in blocks so the temporaries
+stay bounded on large granules. The candidate photons are sorted along
+track, which keeps the tree build cheap and the queries cache friendly.
+
+For granules with too many candidates to hold the neighbor arrays in
+memory, the points can also be processed in along track windows. Each
+window is padded with enough neighboring points, on either side, that
+its results are identical to processing all of the points at once.
+
+Tolerance: results match sklearn to within a relative difference of
+1e-9. The only exceptions are photons whose k-th nearest neighbor is
+tied in distance with the (k+1)-th, or that have more than k exact
+duplicates. The two engines may then break the tie differently, which
+is the same ambiguity sklearn itself has between its tree algorithms.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Points processed per neighbor query block
+BLOCK_SIZE = 1 << 20
+
+# Relative tolerance with respect to sklearn, see above
+RTOL = 1e-9
+
+
+def _kneighbors(tree, p, k, workers):
+
+    n = len(p)
+    index_type = np.int32 if n < np.iinfo(np.int32).max else np.int64
+    distances = np.empty((n, k))
+    indices = np.empty((n, k), dtype=index_type)
+
+    for start in range(0, n, BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, n)
+
+        # Query one extra neighbor, since each point finds itself
+        d, i = tree.query(p[start:stop], k=k + 1, workers=workers)
+
+        # Drop the point itself. With duplicates it may not be in the
+        # first column, and if it is missing, drop the first column.
+        keep = i != np.arange(start, stop)[:, np.newaxis]
+        keep[keep.all(axis=1), 0] = False
+        distances[start:stop] = d[keep].reshape(-1, k)
+        indices[start:stop] = i[keep].reshape(-1, k)
+
+    return distances, indices
+
+
+def _lof(p, k, workers):
+
+    n = len(p)
+
+    # Find the neighbors of every point
+    tree = cKDTree(p, balanced_tree=False)
+    distances, indices = _kneighbors(tree, p, k, workers)
+    del tree
+
+    # Distance to the k-th neighbor
+    k_distance = distances[:, -1].copy()
+
+    # Local reachability densities
+    lrd = np.empty(n)
+    for start in range(0, n, BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, n)
+        i = indices[start:stop]
+        reach = np.maximum(distances[start:stop], k_distance[i])
+        # 1e-10 to avoid nan when there are more than k duplicates
+        lrd[start:stop] = 1.0 / (reach.mean(axis=1) + 1e-10)
+    del distances
+
+    # Negative LOF is the mean neighbor/point density ratio
+    nof = np.empty(n)
+    for start in range(0, n, BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, n)
+        i = indices[start:stop]
+        nof[start:stop] = -(lrd[i] / lrd[start:stop, np.newaxis]).mean(axis=1)
+
+    return nof, indices, k_distance
+
+
+def _lof_windowed(p, k, workers, window):
+
+    n = len(p)
+    nof = np.empty(n)
+
+    # Largest x before, and smallest x after, each position
+    x = p[:, 0]
+    left_max = np.maximum.accumulate(x)
+    right_min = np.minimum.accumulate(x[::-1])[::-1]
+
+    margin = 8 * k
+    for start in range(0, n, window):
+        stop = min(start + window, n)
+
+        # Widen the overlap until every point in [start, stop) is exact
+        while True:
+            lo = max(0, start - margin)
+            hi = min(n, stop + margin)
+            w, indices, k_distance = _lof(p[lo:hi], k, workers)
+
+            # A neighbor set is exact if no point outside the window
+            # can be as close as the k-th neighbor
+            exact = np.ones(hi - lo, dtype=bool)
+            if lo > 0:
+                exact &= k_distance < x[lo:hi] - left_max[lo - 1]
+            if hi < n:
+                exact &= k_distance < right_min[hi] - x[lo:hi]
+
+            # LOF depends on the neighbors' neighbors' neighbor sets
+            exact &= exact[indices].all(axis=1)
+            exact &= exact[indices].all(axis=1)
+
+            if exact[start - lo:stop - lo].all() or (lo == 0 and hi == n):
+                break
+            margin *= 2
+
+        nof[start:stop] = w[start - lo:stop - lo]
+
+    return nof
+
+
+def negative_outlier_factor(p, n_neighbors=16, workers=-1, window=None):
+
+    p = np.ascontiguousarray(p, dtype=np.float64)
+    n = len(p)
+    k = max(1, min(n_neighbors, n - 1))
+
+    # Optionally work through along track windows of points, with enough
+    # overlap at the edges that the result does not change
+    if window is not None and window < n:
+        return _lof_windowed(p, k, workers, window)
+
+    return _lof(p, k, workers)[0]
+
+
+def negative_outlier_factor_sklearn(p, n_neighbors=16):
+
+    # Reference implementation
+    from sklearn.neighbors import LocalOutlierFactor
+    lof = LocalOutlierFactor(n_neighbors=n_neighbors)
+    lof.fit(p)
+    return lof.negative_outlier_factor_
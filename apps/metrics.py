@@ -0,0 +1,130 @@
+"""
+ATL24 track stacker scoring metrics
+
+All of the scores are computed from one confusion matrix per algorithm,
+over the ASPRS labels that appear in the reference or in any of the
+predictions. The matrices for every algorithm are counted together with
+a single np.bincount over encoded (algorithm, reference, prediction)
+triples.
+"""
+
+import math
+import numpy as np
+
+# Rows encoded per bincount call, to bound temporaries
+BLOCK_SIZE = 1 << 22
+
+
+def get_confusion_matrices(y, predictions):
+
+    # y is the reference labels, and predictions is a list with one array
+    # of predicted labels for each algorithm
+    y = np.asarray(y)
+    predictions = [np.asarray(p) for p in predictions]
+
+    # Labels present anywhere, in sorted order
+    labels = np.unique(np.concatenate([np.unique(y)] +
+                                      [np.unique(p) for p in predictions]))
+    k = len(labels)
+    a = len(predictions)
+
+    # Counts indexed by (algorithm, reference, prediction)
+    counts = np.zeros(a * k * k, dtype=np.int64)
+    offsets = np.arange(a) * k * k
+    for start in range(0, len(y), BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, len(y))
+        r = np.searchsorted(labels, y[start:stop]) * k
+        codes = np.column_stack([np.searchsorted(labels, p[start:stop])
+                                 for p in predictions])
+        codes += r[:, np.newaxis] + offsets
+        counts += np.bincount(codes.ravel(), minlength=a * k * k)
+
+    return labels, counts.reshape(a, k, k)
+
+
+def exclude_reference(labels, m, label):
+
+    # Drop the photons whose reference is label
+    m = m.copy()
+    i = np.searchsorted(labels, label)
+    if i < len(labels) and labels[i] == label:
+        m[i, :] = 0
+    return m
+
+
+def get_multiclass_scores(m):
+
+    # Only labels that occur in the reference or the prediction count
+    tp = np.diag(m)
+    support = m.sum(axis=1)
+    predicted = m.sum(axis=0)
+    present = (support + predicted) > 0
+    fp = predicted - tp
+    fn = support - tp
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f1 = np.where(2 * tp + fp + fn > 0,
+                      2 * tp / (2 * tp + fp + fn),
+                      0.0)
+
+    total = support.sum()
+    acc = tp.sum() / total
+    weighted_f1 = (f1 * support).sum() / total
+    macro_f1 = f1[present].mean()
+    micro_f1 = 2 * tp.sum() / (2 * tp.sum() + fp.sum() + fn.sum())
+
+    return acc, weighted_f1, macro_f1, micro_f1
+
+
+def get_binary_counts(labels, m, pos_label):
+
+    # Collapse to positive vs. everything else
+    i = np.searchsorted(labels, pos_label)
+    if i < len(labels) and labels[i] == pos_label:
+        TP = m[i, i]
+        FN = m[i, :].sum() - TP
+        FP = m[:, i].sum() - TP
+    else:
+        TP = FN = FP = np.int64(0)
+    TN = m.sum() - TP - FN - FP
+
+    return TN, FP, FN, TP
+
+
+def get_binary_scores(TN, FP, FN, TP):
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        PP = TP + FP
+        PN = TN + FN
+        TPR = TP / (TP + FN)
+        FPR = FP / (FP + TN)
+        TNR = 1.0 - FPR
+        FNR = 1.0 - TPR
+        PPV = TP / PP
+        NPV = TN / PN
+        FOR = FN / PN
+        FDR = FP / PP
+        acc = (TP + TN) / (TP + TN + FP + FN)
+        f1 = (2*TP) / (2*TP + FP + FN)
+        ba = (TPR + TNR) / 2.0
+        mcc = (math.sqrt(TPR * TNR * PPV * NPV) -
+               math.sqrt(FNR * FPR * FOR * FDR))
+        r0 = 0.5
+        cal_f1 = 2.0 * TPR / (TPR + (1.0 / r0) * FPR + 1)
+        avg = (f1 + ba + cal_f1 + mcc) / 4.0
+
+    return acc, f1, ba, cal_f1, mcc, avg
+
+
+def merge_confusion_matrices(parts):
+
+    # Sum (labels, matrices) pairs that may have different label sets
+    labels = np.unique(np.concatenate([p[0] for p in parts]))
+    a = parts[0][1].shape[0]
+    k = len(labels)
+    total = np.zeros((a, k, k), dtype=np.int64)
+    for part_labels, m in parts:
+        i = np.searchsorted(labels, part_labels)
+        total[:, i[:, np.newaxis], i[np.newaxis, :]] += m
+
+    return labels, total
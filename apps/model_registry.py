@@ -0,0 +1,183 @@
+"""
+ATL24 track stacker model registry
+
+Models are saved as models/model-YYYYMMDD.json. A model can be named by
+its path, by its date, or as 'latest'. Loaded models are kept in a
+small in-memory LRU, so that switching between models costs nothing
+after the first load.
+
+Each saved model has a sha256sum style sidecar, model-YYYYMMDD.json.sha256.
+A model with a sidecar is only loaded when its contents match the
+checksum, and the booster is built from the same bytes that were checked.
+Models are saved atomically, so a reader never sees a partial file.
+"""
+
+import collections
+import hashlib
+import os
+import re
+import threading
+import time
+import fileutil
+
+DEFAULT_MODEL_DIR = os.path.normpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'models'))
+DEFAULT_MAX_MODELS = 4
+
+CHECKSUM_SUFFIX = '.sha256'
+
+# A model can be replaced between reading it and reading its checksum,
+# so a mismatch is retried a few times before giving up
+CHECKSUM_RETRIES = 3
+CHECKSUM_RETRY_SECONDS = 0.1
+
+MODEL_PATTERN = re.compile(r'model-(\d{8})\.json$')
+DATE_PATTERN = re.compile(r'(\d{4})-?(\d{2})-?(\d{2})$')
+
+
+def get_checksum_filename(model_filename):
+    return model_filename + CHECKSUM_SUFFIX
+
+
+def get_model_filename(spec, model_dir=DEFAULT_MODEL_DIR):
+
+    # 'latest', a date as YYYYMMDD or YYYY-MM-DD, or a path
+    if spec == 'latest':
+        dates = [m.group(1) for m in map(MODEL_PATTERN.match,
+                                         os.listdir(model_dir)) if m]
+        if not dates:
+            raise FileNotFoundError(f'No dated models in {model_dir}')
+        return os.path.join(model_dir, f'model-{max(dates)}.json')
+
+    m = DATE_PATTERN.match(spec)
+    if m and not os.path.exists(spec):
+        return os.path.join(model_dir, f'model-{"".join(m.groups())}.json')
+
+    return spec
+
+
+def read_checksum(model_filename):
+
+    # Returns None when the model has no sidecar
+    try:
+        with open(get_checksum_filename(model_filename)) as f:
+            return f.read().split()[0].lower()
+    except FileNotFoundError:
+        return None
+
+
+def read_model_bytes(model_filename):
+
+    # Returns the model contents once they match the sidecar
+    for attempt in range(CHECKSUM_RETRIES):
+        with open(model_filename, 'rb') as f:
+            b = f.read()
+        checksum = read_checksum(model_filename)
+        if checksum is None or hashlib.sha256(b).hexdigest() == checksum:
+            return b
+        time.sleep(CHECKSUM_RETRY_SECONDS)
+
+    raise ValueError(f'{model_filename} does not match its checksum')
+
+
+def load_booster(model_filename):
+
+    # XGBoost is slow to import, and is not needed to run a compiled
+    # model that is already built
+    import xgboost as xgb
+    booster = xgb.Booster()
+    booster.load_model(bytearray(read_model_bytes(model_filename)))
+    return trim(booster)
+
+
+def load_model(model_filename, nthread=0):
+
+    # A booster that predicts with nthread threads, 0 for all cores
+    booster = load_booster(model_filename)
+    booster.set_param({'nthread': nthread})
+    return booster
+
+
+def trim(booster):
+
+    # Only the trees up to the best iteration of an early stopped model
+    # are used to predict
+    best = booster.attr('best_iteration')
+    if best is None or int(best) + 1 >= booster.num_boosted_rounds():
+        return booster
+    return booster[:int(best) + 1]
+
+
+def get_checksum(filename):
+
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def write_checksum(model_filename, checksum=None):
+
+    if checksum is None:
+        checksum = get_checksum(model_filename)
+
+    # Same format as sha256sum, so that 'sha256sum -c' can check it
+    name = os.path.basename(model_filename)
+    with fileutil.atomic_write(get_checksum_filename(model_filename)) as tmp:
+        with open(tmp, 'w') as f:
+            f.write(f'{checksum}  {name}\n')
+
+
+def save_model(model, model_filename):
+
+    # Save an XGBClassifier or Booster and its checksum. The temporary
+    # file keeps the .json extension so that XGBoost writes JSON.
+    with fileutil.atomic_write(model_filename, suffix='.tmp.json') as tmp:
+        model.save_model(tmp)
+        checksum = get_checksum(tmp)
+
+    write_checksum(model_filename, checksum)
+
+
+class ModelRegistry:
+
+    def __init__(self,
+                 model_dir=DEFAULT_MODEL_DIR,
+                 max_models=DEFAULT_MAX_MODELS,
+                 loader=load_model):
+
+        # loader(model_filename, nthread) builds a model. Models are
+        # configured when they are loaded, and not changed after that,
+        # since other threads may be predicting with them.
+        self.model_dir = model_dir
+        self.max_models = max_models
+        self.loader = loader
+        self.models = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def resolve(self, spec):
+        return get_model_filename(spec, self.model_dir)
+
+    def get(self, spec, nthread=0):
+
+        # Models are keyed by file identity, so a model that is replaced
+        # on disk is loaded again
+        model_filename = self.resolve(spec)
+        st = os.stat(model_filename)
+        key = (os.path.abspath(model_filename),
+               st.st_mtime_ns,
+               st.st_size,
+               nthread)
+
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+
+        model = self.loader(model_filename, nthread)
+
+        with self.lock:
+            self.models[key] = model
+            self.models.move_to_end(key)
+            while len(self.models) > self.max_models:
+                self.models.popitem(last=False)
+
+        return model
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Pack granules into a photon store
+
+All of the granules are written to one Arrow IPC file, one record batch
+per granule, with the compact photon column types. The index next to
+it maps each granule name to its record batch and row range. Once
+packed, the apps can read granules from the store with --store, without
+parsing any text.
+"""
+
+import argparse
+import json
+import os
+import sys
+import pyarrow as pa
+import fileutil
+import photon_io
+
+# Columns kept in a store, in order
+STORE_COLUMNS = ['index_ph'] + [c for c in photon_io.PHOTON_TYPES
+                                if c != 'prediction']
+
+
+def get_table(df, columns):
+
+    # Same columns and types for every granule
+    df = photon_io.rename_columns(df)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for c in columns:
+        if c not in table.column_names:
+            t = photon_io.PHOTON_TYPES.get(c, pa.int64())
+            table = table.append_column(c, pa.nulls(table.num_rows, t))
+    return photon_io.apply_schema(table.select(columns))
+
+
+def main(args):
+
+    # Show args
+    if args.verbose:
+        print(args, file=sys.stderr)
+
+    filenames = sorted(photon_io.glob_photons(args.input_glob))
+    if not filenames:
+        raise FileNotFoundError(f'No files match {args.input_glob}')
+
+    names = [os.path.basename(fn) for fn in filenames]
+    if len(set(names)) != len(names):
+        raise ValueError('Granule names must be unique')
+
+    # Keep the known columns of any granule. Granules without one of
+    # them get nulls, or 0 for labels. Only the headers are read.
+    available = set()
+    for fn in filenames:
+        available.update(photon_io.get_columns(fn))
+    for old, new in photon_io.RENAMED_COLUMNS.items():
+        if old in available:
+            available.add(new)
+    columns = [c for c in STORE_COLUMNS if c in available]
+
+    # Old granules have these columns under their old names
+    read_columns = columns + [old for old, new
+                              in photon_io.RENAMED_COLUMNS.items()
+                              if new in columns]
+
+    if args.verbose:
+        print(f'Packing {len(filenames)} granules into {args.output}'
+              f' with columns {columns}', file=sys.stderr)
+
+    granules = []
+    start = 0
+    with fileutil.atomic_write(args.output, suffix='.tmp.arrow') as tmp:
+        writer = None
+        schema = None
+        granules_read = photon_io.prefetch_photons(filenames,
+                                                   read_columns,
+                                                   depth=args.prefetch)
+        for n, (name, df) in enumerate(zip(names, granules_read)):
+
+            if args.verbose:
+                print(f'Packing {n + 1} of {len(filenames)}: {name}'
+                      f', {len(df.index)} rows', file=sys.stderr)
+
+            table = get_table(df, columns)
+            del df
+            if writer is None:
+                schema = table.schema
+                writer = pa.ipc.new_file(tmp, schema)
+            else:
+                table = table.cast(schema)
+
+            # One record batch per granule
+            batches = table.combine_chunks().to_batches()
+            if batches:
+                writer.write_batch(batches[0])
+            else:
+                writer.write_batch(
+                    pa.RecordBatch.from_pylist([], schema=schema))
+            granules.append({'name': name,
+                             'start': start,
+                             'rows': table.num_rows})
+            start += table.num_rows
+        writer.close()
+
+    index = {'version': photon_io.STORE_VERSION, 'granules': granules}
+    with fileutil.atomic_write(
+            args.output + photon_io.STORE_INDEX_SUFFIX) as tmp:
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+
+    if args.verbose:
+        size = os.path.getsize(args.output)
+        print(f'Packed {start} rows, {size >> 20} MB', file=sys.stderr)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Pack granules into a photon store')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Show verbose output')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='Output store filename, e.g. photons.arrow')
+    parser.add_argument(
+        '--prefetch', type=int, default=photon_io.PREFETCH_DEPTH,
+        help='Number of granules to read ahead')
+    parser.add_argument(
+        'input_glob',
+        help='Input granule filename glob')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,402 @@
+"""
+ATL24 track stacker photon table I/O
+
+Photon tables can be CSV, Parquet or Arrow IPC (Feather) files. The
+format is picked by file extension.
+
+Granules can also be read from a photon store, an Arrow IPC file that
+holds many granules with one record batch each, and a JSON index of
+the granules. Stores are memory mapped, so granules are read without
+parsing or copying the file. A granule in a store is named
+<store>#<granule>, and can be used anywhere a filename can.
+
+Columns are read with compact types. ASPRS labels fit in int8, and
+heights, densities and probabilities only need float32. x_atc stays
+float64, since float32 resolves only a few centimeters at the along
+track distances of a granule. Missing labels are read as 0,
+'unclassified'.
+"""
+
+import collections
+import fnmatch
+import functools
+import glob
+import itertools
+import json
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as csv
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+
+PARQUET_EXTENSIONS = ['.parquet', '.pq']
+FEATHER_EXTENSIONS = ['.feather', '.arrow', '.ipc']
+
+# Label columns. 'prediction' is the old name of 'qtrees'.
+LABEL_COLUMNS = [
+    'qtrees',
+    'prediction',
+    'cshelph',
+    'medianfilter',
+    'bathypathfinder',
+    'openoceanspp',
+    'coastnet',
+    'manual_label',
+    'ensemble',
+    ]
+
+# Old column names, and their current names
+RENAMED_COLUMNS = {'prediction': 'qtrees'}
+
+# Photon column types. Columns that are not listed keep their inferred
+# types.
+PHOTON_TYPES = {
+    'x_atc': pa.float64(),
+    'geoid_corr_h': pa.float32(),
+    'surface_h': pa.float32(),
+    'density': pa.float32(),
+    'ensemble_bathy_prob': pa.float32(),
+    **{c: pa.int8() for c in LABEL_COLUMNS},
+    }
+
+# Bytes sampled from the start of a CSV to estimate its row size
+CSV_SAMPLE_BYTES = 1 << 16
+
+# Largest CSV block read at a time. pyarrow block sizes are int32.
+MAX_CSV_BLOCK_BYTES = 1 << 30
+
+# Number of files read ahead of the one being processed
+PREFETCH_DEPTH = 2
+
+# Photon store granule names are <store>#<granule>
+STORE_SEPARATOR = '#'
+STORE_INDEX_SUFFIX = '.index.json'
+STORE_VERSION = 1
+
+# Same types for pandas
+PHOTON_DTYPES = {c: t.to_pandas_dtype() for c, t in PHOTON_TYPES.items()}
+
+
+def split_store_filename(filename):
+
+    # Returns the store and granule name, or None if this is a file
+    store, sep, name = filename.rpartition(STORE_SEPARATOR)
+    if not sep or os.path.exists(filename):
+        return None
+    if not os.path.exists(store + STORE_INDEX_SUFFIX):
+        return None
+    return store, name
+
+
+def get_format(filename):
+
+    if split_store_filename(filename) is not None:
+        return 'store'
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in PARQUET_EXTENSIONS:
+        return 'parquet'
+    if ext in FEATHER_EXTENSIONS:
+        return 'feather'
+    return 'csv'
+
+
+def get_columns(filename):
+
+    # Get column names without reading any data
+    fmt = get_format(filename)
+    if fmt == 'parquet':
+        return pq.read_schema(filename).names
+    if fmt == 'feather':
+        with pa.memory_map(filename) as source:
+            return pa.ipc.open_file(source).schema.names
+    if fmt == 'store':
+        return open_store(split_store_filename(filename)[0]).schema.names
+    with open(filename) as f:
+        return f.readline().strip().split(',')
+
+
+class PhotonStore:
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename + STORE_INDEX_SUFFIX) as f:
+            index = json.load(f)
+        if index.get('version') != STORE_VERSION:
+            raise ValueError(f'{filename} has an unsupported index version')
+        self.granules = index['granules']
+        self.batches = {g['name']: n for n, g in enumerate(self.granules)}
+
+        # The memory map stays open for the life of the store
+        self.source = pa.memory_map(filename)
+        self.reader = pa.ipc.open_file(self.source)
+        self.schema = self.reader.schema
+        if self.reader.num_record_batches != len(self.granules):
+            raise ValueError(f'{filename} does not match its index')
+
+    def get_names(self, pattern='*'):
+
+        # Granule names that match a glob pattern, in store order
+        return [g['name'] for g in self.granules
+                if fnmatch.fnmatchcase(g['name'], pattern)]
+
+    def get_batch(self, name, columns=None):
+
+        # A view of a granule in the memory map, without copying it
+        try:
+            batch = self.reader.get_batch(self.batches[name])
+        except KeyError:
+            raise KeyError(f'{name} is not in {self.filename}') from None
+        if columns is not None:
+            batch = batch.select(columns)
+        return batch
+
+
+@functools.lru_cache(maxsize=None)
+def open_store(filename):
+
+    # Each store is only opened once per process
+    return PhotonStore(filename)
+
+
+def get_store_filename(store_filename, name):
+    return f'{store_filename}{STORE_SEPARATOR}{name}'
+
+
+def get_granule_name(filename):
+
+    # Same name for a granule file and its copy in a store
+    split = split_store_filename(filename)
+    if split is not None:
+        return split[1]
+    return os.path.basename(filename)
+
+
+def glob_photons(pattern, store_filename=None):
+
+    # Files matching a glob, or the granules in a store whose names
+    # match the pattern's basename
+    if store_filename is None:
+        return glob.glob(pattern)
+    store = open_store(store_filename)
+    return [get_store_filename(store_filename, name)
+            for name in store.get_names(os.path.basename(pattern))]
+
+
+def iter_blocks(filename, block_size=1 << 20):
+
+    # The raw contents of a file, or the buffers of a store granule
+    split = split_store_filename(filename)
+    if split is not None:
+        store, name = split
+        for column in open_store(store).get_batch(name).columns:
+            for b in column.buffers():
+                if b is not None:
+                    yield memoryview(b)
+        return
+
+    with open(filename, 'rb') as f:
+        while True:
+            b = f.read(block_size)
+            if not b:
+                break
+            yield b
+
+
+def rename_columns(df):
+
+    # Give old columns their current names, unless both are present
+    renames = {old: new for old, new in RENAMED_COLUMNS.items()
+               if old in df.columns and new not in df.columns}
+    return df.rename(columns=renames) if renames else df
+
+
+def apply_schema(table):
+
+    # Cast a pyarrow table or record batch to the photon column types
+    if isinstance(table, pa.RecordBatch):
+        table = pa.Table.from_batches([table])
+
+    for n, name in enumerate(table.column_names):
+        t = PHOTON_TYPES.get(name)
+        if t is None:
+            continue
+        column = table.column(n)
+        if column.type != t:
+            column = column.cast(t)
+        if name in LABEL_COLUMNS and column.null_count:
+            column = pc.fill_null(column, 0)
+        table = table.set_column(n, name, column)
+
+    return table
+
+
+def get_csv_convert_options(columns):
+
+    # Parse straight to the photon column types
+    return csv.ConvertOptions(include_columns=columns,
+                              column_types=PHOTON_TYPES)
+
+
+def read_photons(filename, columns=None):
+
+    # Only read the requested columns that are in the file
+    if columns is not None:
+        available = set(get_columns(filename))
+        columns = [c for c in columns if c in available]
+
+    fmt = get_format(filename)
+    if fmt == 'parquet':
+        table = pq.read_table(filename, columns=columns)
+    elif fmt == 'feather':
+        with pa.memory_map(filename) as source:
+            table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(columns)
+    elif fmt == 'store':
+        # Columns without nulls stay in the memory map
+        store, name = split_store_filename(filename)
+        table = open_store(store).get_batch(name, columns)
+        return apply_schema(table).to_pandas(split_blocks=True)
+    else:
+        table = csv.read_csv(
+            filename,
+            convert_options=get_csv_convert_options(columns))
+
+    return apply_schema(table).to_pandas()
+
+
+def prefetch(func, *iterables, depth=PREFETCH_DEPTH):
+
+    # Same as map(func, *iterables), but up to depth calls run ahead of
+    # the caller on background threads. pyarrow releases the GIL while
+    # it reads, so reading the next files overlaps the work on this one.
+    # At most depth results are held besides the one being processed.
+    if depth < 1:
+        yield from map(func, *iterables)
+        return
+
+    args = zip(*iterables)
+    pool = ThreadPoolExecutor(max_workers=depth)
+    pending = collections.deque(pool.submit(func, *a)
+                                for a in itertools.islice(args, depth))
+    try:
+        while pending:
+            result = pending.popleft().result()
+            for a in itertools.islice(args, 1):
+                pending.append(pool.submit(func, *a))
+            yield result
+    finally:
+        # Do not read ahead for a caller that has stopped
+        for f in pending:
+            f.cancel()
+        pool.shutdown()
+
+
+def prefetch_photons(filenames, columns=None, depth=PREFETCH_DEPTH):
+
+    # Read photon tables in order, reading ahead on background threads
+    return prefetch(read_photons,
+                    filenames,
+                    itertools.repeat(columns),
+                    depth=depth)
+
+
+def get_csv_row_bytes(filename):
+
+    # Estimate the average row size from the start of the file
+    with open(filename, 'rb') as f:
+        sample = f.read(CSV_SAMPLE_BYTES)
+    return max(1, len(sample) // max(1, sample.count(b'\n')))
+
+
+def iter_photons(filename, columns=None, chunk_rows=1 << 20):
+
+    # Same as read_photons, but yield along track chunks of about
+    # chunk_rows rows at a time
+    if columns is not None:
+        available = set(get_columns(filename))
+        columns = [c for c in columns if c in available]
+
+    fmt = get_format(filename)
+    if fmt == 'parquet':
+        f = pq.ParquetFile(filename)
+        for batch in f.iter_batches(batch_size=chunk_rows, columns=columns):
+            yield apply_schema(batch).to_pandas()
+    elif fmt == 'feather':
+        with pa.memory_map(filename) as source:
+            reader = pa.ipc.open_file(source)
+            for n in range(reader.num_record_batches):
+                batch = reader.get_batch(n)
+                if columns is not None:
+                    batch = batch.select(columns)
+                for start in range(0, batch.num_rows, chunk_rows):
+                    yield apply_schema(
+                        batch.slice(start, chunk_rows)).to_pandas()
+    elif fmt == 'store':
+        store, name = split_store_filename(filename)
+        batch = open_store(store).get_batch(name, columns)
+        for start in range(0, batch.num_rows, chunk_rows):
+            yield apply_schema(batch.slice(start, chunk_rows)).to_pandas(
+                split_blocks=True)
+    else:
+        block_size = min(chunk_rows * get_csv_row_bytes(filename),
+                         MAX_CSV_BLOCK_BYTES)
+        read_options = csv.ReadOptions(block_size=block_size,
+                                       use_threads=False)
+        reader = csv.open_csv(
+            filename,
+            read_options=read_options,
+            convert_options=get_csv_convert_options(columns))
+        for batch in reader:
+            for start in range(0, batch.num_rows, chunk_rows):
+                yield apply_schema(
+                    batch.slice(start, chunk_rows)).to_pandas()
+
+
+# Write a photon table one chunk at a time
+class PhotonWriter:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.format = get_format(filename)
+        self.writer = None
+        self.rows = 0
+
+    def write(self, df):
+
+        if self.format == 'csv':
+            df.to_csv(self.filename,
+                      mode='w' if self.rows == 0 else 'a',
+                      header=self.rows == 0,
+                      index=False,
+                      float_format='%.7f')
+            self.rows += len(df.index)
+            return
+
+        dtypes = {c: t for c, t in PHOTON_DTYPES.items() if c in df.columns}
+        table = pa.Table.from_pandas(df.astype(dtypes), preserve_index=False)
+        if self.writer is None:
+            if self.format == 'parquet':
+                self.writer = pq.ParquetWriter(self.filename, table.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.filename, table.schema)
+        self.writer.write_table(table)
+        self.rows += len(df.index)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_photons(df, filename):
+
+    with PhotonWriter(filename) as writer:
+        writer.write(df)
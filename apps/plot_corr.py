@@ -5,9 +5,9 @@ ATL24 Bathy Track Stacker
 
 import argparse
 import sys
-import glob
 import matplotlib.pyplot as plt
 import pandas as pd
+import photon_io
 
 
 def plot_corr(fn, title, x):
@@ -28,7 +28,7 @@ def main(args):
         print(args, file=sys.stderr)
 
     # Get the filenames
-    filenames = glob.glob(args.input_glob)
+    filenames = photon_io.glob_photons(args.input_glob, args.store)
 
     if args.verbose:
         print(filenames, file=sys.stderr)
@@ -37,31 +37,39 @@ def main(args):
     # Master dataframe
     df = pd.DataFrame()
 
-    for n, fn in enumerate(filenames):
+    # Only read the columns that are plotted, reading ahead
+    columns = ['index_ph',
+               'geoid_corr_h',
+               'qtrees',
+               'prediction',
+               'cshelph',
+               'medianfilter',
+               'bathypathfinder',
+               'openoceanspp',
+               'coastnet',
+               'manual_label']
+    granules = photon_io.prefetch_photons(filenames,
+                                          columns,
+                                          depth=args.prefetch)
+
+    for n, (fn, d) in enumerate(zip(filenames, granules)):
 
         if args.verbose:
             print(f'Reading {n + 1} of {len(filenames)}: {fn}')
 
-        d = pd.read_csv(fn, engine='pyarrow')
-
         if args.verbose:
             print(f'Read {len(df.index)} rows')
 
-        if 'qtrees' in d.columns:
-            QTREES_LABEL = 'qtrees'
-        else:
-            QTREES_LABEL = 'prediction'
-
+        d = photon_io.rename_columns(d)
         d = d[['index_ph',
                'geoid_corr_h',
-               QTREES_LABEL,
+               'qtrees',
                'cshelph',
                'medianfilter',
                'bathypathfinder',
                'openoceanspp',
                'coastnet',
                'manual_label']]
-        d.rename(columns={"prediction": "qtrees"})
 
         if args.verbose:
             print(d.columns)
@@ -105,6 +113,16 @@ if __name__ == "__main__":
     parser.add_argument(
         '-v', '--verbose', action='store_true',
         help='Show verbose output')
+    parser.add_argument(
+        '--store',
+        type=str,
+        help='Read granules from this photon store, matching the glob'
+             ' against granule names')
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=photon_io.PREFETCH_DEPTH,
+        help='Number of files to read ahead')
     parser.add_argument(
         'input_glob',
         type=str,
@@ -0,0 +1,127 @@
+"""
+ATL24 track stacker stage instrumentation
+
+The apps time their stages with Stats.stage(). Each stage records its
+wall time, the CPU time of the process, the number of rows, and the RSS
+of the process at the end of the stage. ru_maxrss is the peak over the
+whole life of the process, not of the stage, so it is recorded as
+process_peak_rss_mb. With --stats, each stage is also written as a JSON
+line. --profile writes a profile of the whole run.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+
+def get_peak_rss():
+
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_rss():
+
+    # Current RSS, which unlike the peak goes down again when memory is
+    # freed. The second field of statm is resident pages.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return get_peak_rss()
+
+
+class Stats:
+
+    def __init__(self, filename=None, **fields):
+
+        # Records are written to filename, or to stderr if it is '-', or
+        # not at all if it is None
+        self.filename = filename
+        self.fields = fields
+        self.totals = collections.defaultdict(float)
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+
+        # Stats are passed to worker processes without their totals
+        return self.filename, self.fields
+
+    def __setstate__(self, state):
+        self.__init__(state[0], **state[1])
+
+    def with_fields(self, **fields):
+
+        # Same output, with extra fields in every record
+        return Stats(self.filename, **self.fields, **fields)
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None, **fields):
+
+        # The caller can set record['rows'] once it knows them
+        record = dict(self.fields, stage=name, rows=rows, **fields)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        yield record
+        record['wall_s'] = round(time.perf_counter() - wall, 6)
+        record['cpu_s'] = round(time.process_time() - cpu, 6)
+        record['rss_mb'] = round(get_rss() / (1 << 20), 1)
+        record['process_peak_rss_mb'] = round(get_peak_rss() / (1 << 20), 1)
+        record['pid'] = os.getpid()
+        self.add(record)
+
+    def add(self, record):
+
+        # Also used for records from other processes. Row counts are
+        # often numpy integers.
+        record = dict(self.fields, **record)
+        if record.get('rows') is not None:
+            record['rows'] = int(record['rows'])
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.totals[record['stage']] += record['wall_s']
+            if self.filename == '-':
+                sys.stderr.write(line)
+                sys.stderr.flush()
+            elif self.filename is not None:
+                with open(self.filename, 'a') as f:
+                    f.write(line)
+
+
+def get_stats(args, app):
+
+    # Build stats from command line arguments
+    return Stats(args.stats, app=app)
+
+
+@contextlib.contextmanager
+def profile(filename):
+
+    # cProfile by default, or a pyinstrument HTML report
+    if filename is None:
+        yield
+    elif filename.endswith('.html'):
+        import pyinstrument
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(filename, 'w') as f:
+                f.write(profiler.output_html())
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(filename)
+
@@ -4,16 +4,35 @@ compute metrics.
 """
 
 import argparse
+import json
+import os
+import re
 import pandas as pd
-import glob
-import math
 import sys
-from sklearn.metrics import accuracy_score
-from sklearn.metrics import confusion_matrix
-from sklearn.metrics import f1_score
-
-
-def score_all(c, a, y, d, headers=False):
+import numpy as np
+import fileutil
+import metrics
+import photon_io
+import profiling
+from concurrent.futures import ProcessPoolExecutor
+
+# Scored algorithms, in output order
+ALGORITHMS = [
+    'bathypathfinder',
+    'coastnet',
+    'cshelph',
+    'medianfilter',
+    'openoceanspp',
+    'qtrees',
+    'ensemble',
+    ]
+
+# Per-file confusion counts are saved next to each file with this suffix
+COUNTS_SUFFIX = '.counts.json'
+COUNTS_VERSION = 1
+
+
+def score_all(c, a, m, headers=False):
 
     if headers is True:
         print(f'Cls'
@@ -24,11 +43,7 @@ def score_all(c, a, y, d, headers=False):
               f'\tMicroF1')
 
     # Get the scores
-    p = d[a]
-    acc = accuracy_score(y, p)
-    weighted_f1 = f1_score(y, p, average="weighted")
-    macro_f1 = f1_score(y, p, average="macro")
-    micro_f1 = f1_score(y, p, average="micro")
+    acc, weighted_f1, macro_f1, micro_f1 = metrics.get_multiclass_scores(m)
     print(f'{c}'
           f'\t{a}'
           f'\t{acc:0.3f}'
@@ -37,15 +52,7 @@ def score_all(c, a, y, d, headers=False):
           f'\t{micro_f1:0.3f}')
 
 
-def score_binary(c, a, y, df, pos_label, headers=False):
-
-    # Replace values
-    r = y.copy()
-    d = df.copy()
-    r[r != pos_label] = 0
-    d[d != pos_label] = 0
-    r[r != pos_label] = 1
-    d[d != pos_label] = 1
+def score_binary(c, a, labels, m, pos_label, headers=False):
 
     if headers is True:
         print(f'Cls'
@@ -59,25 +66,8 @@ def score_binary(c, a, y, df, pos_label, headers=False):
               )
 
     # Get the scores
-    p = d[a]
-    TN, FP, FN, TP = confusion_matrix(r, p).ravel()
-    PP = TP + FP
-    PN = TN + FN
-    TPR = TP / (TP + FN)
-    FPR = FP / (FP + TN)
-    TNR = 1.0 - FPR
-    FNR = 1.0 - TPR
-    PPV = TP / PP
-    NPV = TN / PN
-    FOR = FN / PN
-    FDR = FP / PP
-    acc = (TP + TN) / (TP + TN + FP + FN)
-    f1 = (2*TP) / (2*TP + FP + FN)
-    ba = (TPR + TNR) / 2.0
-    mcc = math.sqrt(TPR * TNR * PPV * NPV) - math.sqrt(FNR * FPR * FOR * FDR)
-    r0 = 0.5
-    cal_f1 = 2.0 * TPR / (TPR + (1.0 / r0) * FPR + 1)
-    avg = (f1 + ba + cal_f1 + mcc) / 4.0
+    counts = metrics.get_binary_counts(labels, m, pos_label)
+    acc, f1, ba, cal_f1, mcc, avg = metrics.get_binary_scores(*counts)
     print(f'{c}'
           f'\t{a}'
           f'\t{acc:0.3f}'
@@ -88,82 +78,252 @@ def score_binary(c, a, y, df, pos_label, headers=False):
           f'\t{avg:0.3f}')
 
 
-def main(args):
+def score_matrices(labels, matrices, algorithms, all_classes, verbose):
 
-    # Get the filenames
-    filenames = glob.glob(args.input_glob)
+    # Score each algorithm
+    for n, a in enumerate(algorithms):
 
-    if args.verbose:
-        print(filenames, file=sys.stderr)
-        print(f'{len(filenames)} total files', file=sys.stderr)
+        headers = True if n == 0 else False
 
-    df = pd.DataFrame()
+        if verbose:
+            print(f'Scoring {a}', file=sys.stderr)
 
-    if args.ensemble_only:
-        algorithms = [
-            'ensemble',
-            ]
+        m = matrices[n]
+        if all_classes:
+            score_all('all', a, m, headers)
+        else:
+            # Remove photons labeled as surface
+            m2 = metrics.exclude_reference(labels, m, 41)
+            if verbose:
+                print(f'Removed {m.sum() - m2.sum()} surface photons',
+                      file=sys.stderr)
+
+            score_binary('surface', a, labels, m, 41, headers)
+            score_binary('bathy', a, labels, m, 40)
+            score_binary('nonsurface', a, labels, m2, 40)
+
+
+def score(df, algorithms, all_classes, verbose):
+
+    y = df['manual_label'].to_numpy()
+
+    if verbose:
+        print('Y=', file=sys.stderr)
+        print(df['manual_label'].describe(), file=sys.stderr)
+        print(f'unique(y): {df["manual_label"].unique()}', file=sys.stderr)
+
+    # Count every algorithm's confusion matrix in one pass
+    labels, matrices = metrics.get_confusion_matrices(
+        y, [df[a].to_numpy() for a in algorithms])
+
+    score_matrices(labels, matrices, algorithms, all_classes, verbose)
+
+
+def read_counts(fn):
+
+    # Read a counts sidecar, if it is current
+    try:
+        with open(fn + COUNTS_SUFFIX) as f:
+            c = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    st = os.stat(fn)
+    if (c.get('version') != COUNTS_VERSION or
+            c.get('size') != st.st_size or
+            c.get('mtime_ns') != st.st_mtime_ns):
+        return None
+
+    return c
+
+
+def write_counts(fn, c):
+
+    with fileutil.atomic_write(fn + COUNTS_SUFFIX) as tmp:
+        with open(tmp, 'w') as f:
+            json.dump(c, f)
+
+
+def get_file_counts(fn, use_sidecars):
+
+    # Get the confusion counts of every algorithm in one file
+    if use_sidecars:
+        c = read_counts(fn)
+        if c is not None:
+            return c
+
+    d = photon_io.read_photons(fn, ['manual_label'] + ALGORITHMS)
+    algorithms = [a for a in ALGORITHMS if a in d.columns]
+    labels, matrices = metrics.get_confusion_matrices(
+        d['manual_label'].to_numpy(), [d[a].to_numpy() for a in algorithms])
+
+    c = {
+        'version': COUNTS_VERSION,
+        'rows': len(d.index),
+        'labels': labels.tolist(),
+        'counts': {a: matrices[n].tolist()
+                   for n, a in enumerate(algorithms)},
+        }
+
+    if use_sidecars:
+        st = os.stat(fn)
+        c['size'] = st.st_size
+        c['mtime_ns'] = st.st_mtime_ns
+        write_counts(fn, c)
+
+    return c
+
+
+def get_file_matrices(filenames, algorithms, args):
+
+    # Count each file in parallel. Store granules have no sidecars.
+    sidecars = [args.save_counts and photon_io.get_format(fn) != 'store'
+                for fn in filenames]
+    if args.jobs > 1 and len(filenames) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            counts = list(pool.map(get_file_counts, filenames, sidecars))
     else:
-        algorithms = [
-            'bathypathfinder',
-            'coastnet',
-            'cshelph',
-            'medianfilter',
-            'openoceanspp',
-            'qtrees',
-            'ensemble',
-            ]
-
-    for n, fn in enumerate(filenames):
+        counts = list(photon_io.prefetch(get_file_counts,
+                                         filenames,
+                                         sidecars,
+                                         depth=args.prefetch))
+
+    parts = []
+    for fn, c in zip(filenames, counts):
 
         if args.verbose:
-            print(f'Reading {n + 1} of {len(filenames)}: {fn}',
-                  file=sys.stderr)
+            print(f'Counted {c["rows"]} rows: {fn}', file=sys.stderr)
 
-        d = pd.read_csv(fn, engine='pyarrow')
+        missing = [a for a in algorithms if a not in c['counts']]
+        if missing:
+            raise KeyError(f'{fn} has no {", ".join(missing)} column')
 
-        if args.verbose:
-            print(f'Read {len(d.index)} rows', file=sys.stderr)
+        labels = np.array(c['labels'])
+        matrices = np.array([c['counts'][a] for a in algorithms],
+                            dtype=np.int64)
+        parts.append((labels, matrices))
 
-        d = d[['manual_label'] + algorithms]
+    return parts
 
-        if args.verbose:
-            print(d.columns, file=sys.stderr)
 
-        df = pd.concat([df, d])
+def get_breakdown_rows(level, name, labels, matrices, algorithms):
+
+    # Metrics for one granule or group, one row per algorithm and class
+    rows = []
+    for n, a in enumerate(algorithms):
+        m = matrices[n]
+        acc, weighted_f1, macro_f1, micro_f1 = \
+            metrics.get_multiclass_scores(m)
+        rows.append({'level': level,
+                     'name': name,
+                     'algorithm': a,
+                     'cls': 'all',
+                     'rows': m.sum(),
+                     'accuracy': acc,
+                     'weighted_f1': weighted_f1,
+                     'macro_f1': macro_f1,
+                     'micro_f1': micro_f1})
+
+        views = [('surface', m, 41),
+                 ('bathy', m, 40),
+                 ('nonsurface', metrics.exclude_reference(labels, m, 41), 40)]
+        for c, mc, pos_label in views:
+            TN, FP, FN, TP = metrics.get_binary_counts(labels, mc, pos_label)
+            acc, f1, ba, cal_f1, mcc, avg = \
+                metrics.get_binary_scores(TN, FP, FN, TP)
+            rows.append({'level': level,
+                         'name': name,
+                         'algorithm': a,
+                         'cls': c,
+                         'rows': mc.sum(),
+                         'TN': TN,
+                         'FP': FP,
+                         'FN': FN,
+                         'TP': TP,
+                         'accuracy': acc,
+                         'f1': f1,
+                         'ba': ba,
+                         'cal_f1': cal_f1,
+                         'mcc': mcc,
+                         'avg4': avg})
+
+    return rows
+
+
+def get_group(fn, pattern):
+
+    # The group key is the first capture group of the pattern, matched
+    # against the file's basename
+    m = pattern.search(os.path.basename(fn))
+    if m is None:
+        return None
+    return m.group(1) if m.groups() else m.group(0)
+
+
+def save_breakdown(filenames, parts, algorithms, args):
+
+    rows = []
+    for fn, (labels, matrices) in zip(filenames, parts):
+        rows += get_breakdown_rows('granule', fn, labels, matrices,
+                                   algorithms)
+
+    # Aggregate over filename derived keys
+    if args.group_by is not None:
+        pattern = re.compile(args.group_by)
+        groups = {}
+        for fn, part in zip(filenames, parts):
+            key = get_group(fn, pattern)
+            if key is not None:
+                groups.setdefault(key, []).append(part)
+        for key, group in sorted(groups.items()):
+            labels, matrices = metrics.merge_confusion_matrices(group)
+            rows += get_breakdown_rows('group', key, labels, matrices,
+                                       algorithms)
+
+    df = pd.DataFrame(rows)
+    df = df.astype({c: 'Int64' for c in ['TN', 'FP', 'FN', 'TP']})
 
     if args.verbose:
-        print(f'Final dataframe = {df.shape}', file=sys.stderr)
-        print(df.describe(), file=sys.stderr)
+        print(f'Saving {len(df.index)} rows to {args.breakdown}',
+              file=sys.stderr)
 
-    y = df['manual_label'].copy()
+    df.to_parquet(args.breakdown, index=False)
+
+
+def main(args):
+
+    # Get the filenames
+    filenames = photon_io.glob_photons(args.input_glob, args.store)
 
     if args.verbose:
-        print('Y=', file=sys.stderr)
-        print(y.describe(), file=sys.stderr)
-        print(f'unique(y): {y.unique()}', file=sys.stderr)
+        print(filenames, file=sys.stderr)
+        print(f'{len(filenames)} total files', file=sys.stderr)
 
-    # Score each algorithm
-    for n, a in enumerate(algorithms):
+    if args.ensemble_only:
+        algorithms = ['ensemble']
+    else:
+        algorithms = ALGORITHMS
 
-        headers = True if n == 0 else False
+    stats = profiling.get_stats(args, 'score')
 
-        if args.verbose:
-            print(f'Scoring {a}', file=sys.stderr)
+    with stats.stage('count') as record:
+        parts = get_file_matrices(filenames, algorithms, args)
+        record['rows'] = sum(m[0].sum() for _, m in parts)
 
-        if args.all:
-            score_all('all', a, y, df, headers)
-        else:
-            # Remove photons labeled as surface
-            df2 = df[df.manual_label != 41].copy()
-            y2 = df2['manual_label'].copy()
-            if args.verbose:
-                print(f'Removed {len(df)-len(df2.index)} surface photons',
-                      file=sys.stderr)
+    if args.breakdown is not None:
+        with stats.stage('breakdown', len(parts)):
+            save_breakdown(filenames, parts, algorithms, args)
 
-            score_binary('surface', a, y, df, 41, headers)
-            score_binary('bathy', a, y, df, 40)
-            score_binary('nonsurface', a, y2, df2, 40)
+    with stats.stage('merge', len(parts)):
+        labels, matrices = metrics.merge_confusion_matrices(parts)
+
+    if args.verbose:
+        print(f'{matrices[0].sum()} total rows', file=sys.stderr)
+        print(f'unique(y): {labels[matrices[0].sum(axis=1) > 0]}',
+              file=sys.stderr)
+
+    with stats.stage('score', matrices[0].sum()):
+        score_matrices(labels, matrices, algorithms, args.all, args.verbose)
 
 
 if __name__ == "__main__":
@@ -175,9 +335,45 @@ if __name__ == "__main__":
                         help='Score all classes together')
     parser.add_argument('-e', '--ensemble-only',
                         action="store_true", default=False)
+    parser.add_argument('-j', '--jobs',
+                        type=int, default=os.cpu_count(),
+                        help='Number of files to count in parallel')
+    parser.add_argument('--prefetch',
+                        type=int, default=photon_io.PREFETCH_DEPTH,
+                        help='Number of files to read ahead with --jobs=1')
+    parser.add_argument('--store',
+                        type=str,
+                        help='Read granules from this photon store, matching'
+                             ' the glob against granule names')
+    parser.add_argument('-s', '--save-counts', action='store_true',
+                        help='Save per-file counts next to each file, and'
+                             ' reuse them while the file is unchanged')
+    parser.add_argument('-b', '--breakdown',
+                        type=str,
+                        help='Save per-file metrics to this Parquet file.'
+                             ' Implies --save-counts.')
+    parser.add_argument('-g', '--group-by',
+                        type=str,
+                        help='Also aggregate the breakdown by this regular'
+                             ' expression, matched against each basename.'
+                             ' The first capture group, if any, is the key.')
+    parser.add_argument('--stats',
+                        type=str,
+                        help="Append per stage timings as JSON lines to this"
+                             " file, or '-' for stderr")
+    parser.add_argument('--profile',
+                        type=str,
+                        help='Write a cProfile dump of the main process to'
+                             ' this file, or a pyinstrument report if it'
+                             ' ends in .html')
     parser.add_argument('input_glob',
                         type=str,
                         help='Input training filename glob')
     args = parser.parse_args()
 
-    main(args)
+    # Breakdowns are rerun often, so only changed files are recounted
+    if args.breakdown is not None:
+        args.save_counts = True
+
+    with profiling.profile(args.profile):
+        main(args)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Generate synthetic ATL24-like granules
+
+A granule is an along track profile of sea surface, seafloor and noise
+photons, with a manual label and the six algorithm label columns. The
+algorithms each agree with the manual label at their own rate. The same
+size and seed always give the same granule.
+"""
+
+import argparse
+import sys
+import numpy as np
+import pandas as pd
+import features
+import photon_io
+
+# Mean along track photon spacing, meters
+PHOTON_SPACING = 0.7
+
+# Fraction of photons of each ASPRS class. Seafloor photons are only
+# kept where the water is shallow enough to see the bottom.
+SURFACE_FRACTION = 0.35
+BATHY_FRACTION = 0.15
+NOISE_FRACTION = 1.0 - SURFACE_FRACTION - BATHY_FRACTION
+
+# Deepest visible seafloor, meters
+MAX_DEPTH = 30.0
+
+# Fraction of photons each algorithm labels the same as the manual label
+ACCURACY = {
+    'qtrees': 0.85,
+    'cshelph': 0.70,
+    'medianfilter': 0.75,
+    'bathypathfinder': 0.60,
+    'openoceanspp': 0.70,
+    'coastnet': 0.90,
+    }
+
+
+def get_granule(n, seed=0):
+
+    rng = np.random.default_rng(seed)
+    x = np.sort(rng.uniform(0.0, PHOTON_SPACING * n, n))
+    length = PHOTON_SPACING * n
+
+    # Sea surface with swell, and a seafloor that slopes down from the
+    # shore and back up
+    surface = 0.5 * np.sin(2.0 * np.pi * x / 150.0)
+    depth = 2.0 + 2.0 * MAX_DEPTH * np.abs(x / length - 0.5)
+    depth += 2.0 * np.sin(2.0 * np.pi * x / 900.0)
+
+    cls = rng.choice([41, 40, 1],
+                     size=n,
+                     p=[SURFACE_FRACTION, BATHY_FRACTION, NOISE_FRACTION])
+    cls[(cls == 40) & (depth > MAX_DEPTH)] = 1
+
+    h = np.where(cls == 41,
+                 surface + rng.normal(0.0, 0.15, n),
+                 -depth + rng.normal(0.0, 0.4, n))
+    noise = cls == 1
+    h[noise] = rng.uniform(-MAX_DEPTH - 20.0, 20.0, noise.sum())
+
+    # Some photons in the water column are labeled as such
+    water = noise & (h < surface) & (h > -depth)
+    cls[water & (rng.uniform(size=n) < 0.1)] = 45
+
+    df = pd.DataFrame({
+        'index_ph': np.arange(n),
+        'x_atc': x,
+        'geoid_corr_h': h,
+        'surface_h': surface + rng.normal(0.0, 0.05, n),
+        })
+
+    # Algorithms only label surface and bathy photons
+    truth = np.where((cls == 40) | (cls == 41), cls, 0)
+    for a in features.ALGORITHMS:
+        wrong = rng.uniform(size=n) >= ACCURACY[a]
+        labels = truth.copy()
+        labels[wrong] = rng.choice([0, 40, 41], size=wrong.sum())
+        df[a] = labels
+
+    df['manual_label'] = cls
+
+    return df
+
+
+def main(args):
+
+    # Show args
+    if args.verbose:
+        print(args, file=sys.stderr)
+
+    for n, fn in enumerate(args.output_filenames):
+        df = get_granule(int(args.size), args.seed + n)
+        if args.verbose:
+            print(f'Writing {len(df.index)} photons to {fn}', file=sys.stderr)
+        photon_io.write_photons(df, fn)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic granules')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Show verbose output')
+    parser.add_argument(
+        '-n', '--size', type=float, default=1e6,
+        help='Number of photons per granule')
+    parser.add_argument(
+        '-s', '--seed', type=int, default=0,
+        help='Random seed of the first granule, incremented for each one')
+    parser.add_argument(
+        'output_filenames', nargs='+',
+        help='Output granules, in CSV, Parquet or Feather format by'
+             ' extension')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -4,156 +4,437 @@ ATL24 Bathy Track Stacker
 """
 
 import argparse
+import hashlib
+import json
+import os
 import sys
-import glob
+import itertools
+import tempfile
+import numpy as np
 import pandas as pd
 import xgboost as xgb
-from sklearn.inspection import permutation_importance
-from sklearn.metrics import classification_report
-from sklearn.metrics import f1_score
-from sklearn.metrics import balanced_accuracy_score
-from sklearn.neighbors import LocalOutlierFactor
-
+import feature_cache
+import features
+import metrics
+import model_registry
+import photon_io
+import profiling
+from concurrent.futures import ProcessPoolExecutor
+
+# Classifier parameters
+MAX_DEPTH = 6
+N_ESTIMATORS = 100
+N_CLASSES = 3
+
+# Training devices
+DEVICES = ['cuda', 'cpu']
+DEFAULT_DEVICE = 'cuda'
+
+# Early stopping. A fraction of the granules is held out, and training
+# stops once the validation metric has not improved for a number of
+# rounds.
+VALIDATION_FRACTION = 0.2
+VALIDATION_SEED = 0
+EARLY_STOPPING_ROUNDS = 10
+
+# Validation metrics, and whether they are maximized
+STOPPING_METRICS = {'mlogloss': False, 'weighted_f1': True}
+DEFAULT_STOPPING_METRIC = 'mlogloss'
+
+
+# Feed granules to XGBoost one at a time
+class GranuleIter(xgb.DataIter):
+
+    def __init__(self, filenames, cache_prefix, cache, verbose, prefetch):
+        self.filenames = filenames
+        self.cache = cache
+        self.verbose = verbose
+        self.prefetch = prefetch
+        self.granules = None
+        self.n = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+
+        if self.n == len(self.filenames):
+            return False
+
+        # Get the next granules' features in the background
+        if self.granules is None:
+            self.granules = photon_io.prefetch(
+                feature_cache.get_granule_features,
+                itertools.repeat(self.cache),
+                self.filenames,
+                depth=self.prefetch)
+
+        fn = self.filenames[self.n]
+
+        if self.verbose:
+            print(f'Reading {self.n + 1} of {len(self.filenames)}: {fn}',
+                  file=sys.stderr)
 
-def main(args):
+        x, labels, _ = next(self.granules)
+        input_data(data=x,
+                   label=features.map_labels(labels),
+                   feature_names=features.FEATURES,
+                   feature_types=features.FEATURE_TYPES)
+        self.n += 1
+
+        return True
+
+    def reset(self):
+        if self.granules is not None:
+            self.granules.close()
+            self.granules = None
+        self.n = 0
+
+
+def extract(fn, cache):
+
+    # Stage records are returned to the caller, since this may run in
+    # another process
+    stats = profiling.Stats(input=fn)
+    records = []
+
+    # Use cached features when possible
+    if cache is not None:
+        key = feature_cache.get_key(fn)
+        with stats.stage('cache') as record:
+            entry = cache.get(key)
+            record['rows'] = 0 if entry is None else len(entry[1])
+        records.append(record)
+        if entry is not None:
+            x, labels, _ = entry
+            return x, labels, records
+
+    # Read a granule
+    with stats.stage('read') as record:
+        d = photon_io.read_photons(fn, features.INPUT_COLUMNS)
+        record['rows'] = len(d.index)
+    records.append(record)
+
+    # Get its features and manual labels
+    with stats.stage('density', len(d.index)) as record:
+        density = features.get_density(d, features.bathy_mask(d))
+        x = features.get_features(d, density)
+        labels = features.get_manual_labels(d)
+    records.append(record)
+
+    if cache is not None:
+        cache.put(key, x, labels, density)
+
+    return x, labels, records
+
+
+def get_params(device=DEFAULT_DEVICE, nthread=0):
+
+    # Booster parameters of the model. An nthread of 0 uses all cores.
+    params = {
+        'objective': 'multi:softprob',
+        'num_class': N_CLASSES,
+        'max_depth': MAX_DEPTH,
+        'tree_method': 'hist',
+        'device': device,
+        }
+    if nthread > 0:
+        params['nthread'] = nthread
+    return params
+
+
+def get_dmatrix(x, y, nthread=0, ref=None):
+
+    # hist training only reads the quantized features, so the features
+    # are quantized once, straight from the float32 matrix. Validation
+    # features use the quantiles of the training features, ref.
+    return xgb.QuantileDMatrix(x,
+                               y,
+                               feature_names=features.FEATURES,
+                               feature_types=features.FEATURE_TYPES,
+                               nthread=nthread or None,
+                               ref=ref)
+
+
+def split_granules(filenames, fraction, seed=VALIDATION_SEED):
+
+    # Whole granules are held out, since photons of one granule are not
+    # independent. They are picked by a hash of the granule name, so the
+    # split does not depend on the order of the files, or on whether
+    # they are read from a store. At least one granule is kept for
+    # training.
+    n = len(filenames)
+    held_out = np.zeros(n, dtype=bool)
+    k = min(int(round(n * fraction)), n - 1)
+    if k > 0:
+        names = [photon_io.get_granule_name(fn) for fn in filenames]
+        keys = [hashlib.sha256(f'{seed}\n{name}'.encode()).hexdigest()
+                for name in names]
+        held_out[np.argsort(keys, kind='stable')[:k]] = True
+    return held_out
+
+
+def get_split_dmatrices(x, y, val, nthread=0):
+
+    # Training and validation features, without validation if no rows
+    # are held out
+    if not val.any():
+        return get_dmatrix(x, y, nthread), None
+    dtrain = get_dmatrix(x[~val], y[~val], nthread)
+    dval = get_dmatrix(x[val], y[val], nthread, ref=dtrain)
+    return dtrain, dval
+
+
+def weighted_f1(predt, dmatrix):
+
+    # Custom XGBoost metric, from the class probabilities
+    y = dmatrix.get_label().astype(np.int64)
+    p = predt.reshape(len(y), -1).argmax(axis=1)
+    _, m = metrics.get_confusion_matrices(y, [p])
+    return 'weighted_f1', metrics.get_multiclass_scores(m[0])[1]
+
+
+def get_device(booster):
+
+    # The device that the booster actually used. XGBoost falls back to
+    # the CPU, with only a warning, when there is no GPU.
+    config = json.loads(booster.save_config())
+    return config['learner']['generic_param']['device']
+
+
+def fit(dtrain, dval, args, stats):
+
+    params = get_params(args.device, args.nthread)
+    evals = []
+    callbacks = []
+    custom_metric = None
+    if dval is not None:
+        params['eval_metric'] = 'mlogloss'
+        evals = [(dval, 'validation')]
+        custom_metric = weighted_f1
+        callbacks = [xgb.callback.EarlyStopping(
+            rounds=args.early_stopping_rounds,
+            metric_name=args.stopping_metric,
+            data_name='validation',
+            maximize=STOPPING_METRICS[args.stopping_metric],
+            save_best=True)]
 
-    # Show args
     if args.verbose:
-        print(args, file=sys.stderr)
+        print(f'Fitting on {args.device}...', file=sys.stderr)
+
+    with stats.stage('fit', dtrain.num_row(), device=args.device) as record:
+        booster = xgb.train(params,
+                            dtrain,
+                            num_boost_round=args.epochs,
+                            evals=evals,
+                            custom_metric=custom_metric,
+                            callbacks=callbacks,
+                            verbose_eval=args.verbose)
+        record['rounds'] = booster.num_boosted_rounds()
+
+    device = get_device(booster)
+    if device != args.device:
+        print(f'Warning: trained on {device} instead of {args.device}',
+              file=sys.stderr)
+
+    # The best model is returned trimmed to its best iteration
+    if dval is not None and args.verbose:
+        print(f'Best iteration {booster.attr("best_iteration")}'
+              f' of {args.epochs}, validation {args.stopping_metric}'
+              f' {float(booster.attr("best_score")):0.5f}',
+              file=sys.stderr)
+
+    # Let XGBClassifier.load_model() read it as a classifier
+    booster.set_attr(
+        scikit_learn=json.dumps({'_estimator_type': 'classifier'}))
+
+    return booster
 
-    # Get the filenames
-    filenames = glob.glob(args.input_glob)
+
+def save(booster, args, stats):
 
     if args.verbose:
-        print(filenames, file=sys.stderr)
-        print(f'{len(filenames)} total files', file=sys.stderr)
+        print(f'Saving to {args.model_filename}', file=sys.stderr)
 
-    # Master dataframe
-    df = pd.DataFrame()
+    with stats.stage('save'):
+        model_registry.save_model(booster, args.model_filename)
 
-    # Extract data and combine into a single dataframe
-    for n, fn in enumerate(filenames):
 
-        if args.verbose:
-            print(f'Reading {n + 1} of {len(filenames)}: {fn}',
-                  file=sys.stderr)
+def print_importances(booster):
 
-        d = pd.read_csv(fn, engine='pyarrow')
+    # Normalized gain, like XGBClassifier.feature_importances_
+    importances = booster.get_score(importance_type='gain')
+    total = sum(importances.values())
+    print(f'{"col":>20}{"importance":>20}', file=sys.stderr)
+    for col in features.FEATURES:
+        v = importances.get(col, 0.0) / total
+        print(f'{col:>20}{v:20.5f}', file=sys.stderr)
 
-        if args.verbose:
-            print(f'Read {len(d.index)} rows', file=sys.stderr)
-
-        # Get indexes of points marked as bathy
-        indexes = d.index[(d['qtrees'] == 40) |
-                          (d['cshelph'] == 40) |
-                          (d['medianfilter'] == 40) |
-                          (d['bathypathfinder'] == 40) |
-                          (d['openoceanspp'] == 40) |
-                          (d['coastnet'] == 40)]
-
-        # Get a list of photons that contain at least one bathy prediction
-        p = d[['x_atc', 'geoid_corr_h']].copy().to_numpy()[indexes]
-
-        # Apply aspect ratio
-        aspect_ratio = 10
-        p[0, :] /= aspect_ratio
-
-        # Compute Local Outlier Factor
-        n_neighbors = 16
-        lof = LocalOutlierFactor(n_neighbors=n_neighbors)
-        lof.fit(p)
-
-        # Get densities of bathy photons
-        density = lof.negative_outlier_factor_
-
-        # Keep only the columns we need
-        d = d[['geoid_corr_h',
-               'surface_h',
-               'qtrees',
-               'cshelph',
-               'medianfilter',
-               'bathypathfinder',
-               'openoceanspp',
-               'coastnet',
-               'manual_label']]
-
-        # Add the density
-        d['density'] = density.max()
-        d.loc[indexes, 'density'] = density
+
+def get_training_data(filenames, args, stats=None):
+
+    if stats is None:
+        stats = profiling.Stats()
+
+    cache = feature_cache.get_cache(args)
+    caches = [cache] * len(filenames)
+
+    # Extract the granules in parallel, or one at a time while the next
+    # ones are read ahead, keeping them in filename order
+    if args.jobs > 1:
+        pool = ProcessPoolExecutor(max_workers=args.jobs)
+        results = pool.map(extract, filenames, caches)
+    else:
+        pool = None
+        results = photon_io.prefetch(extract,
+                                     filenames,
+                                     caches,
+                                     depth=args.prefetch)
+
+    blocks = []
+    for n, (x, labels, records) in enumerate(results):
 
         if args.verbose:
-            print(d.columns, file=sys.stderr)
+            print(f'Read {n + 1} of {len(filenames)}: {filenames[n]}'
+                  f', {len(labels)} rows', file=sys.stderr)
+
+        blocks.append((x, labels))
+        for record in records:
+            stats.add(record)
+
+    if pool is not None:
+        pool.shutdown()
+
+    # Stack the blocks, one copy of each
+    rows = [len(labels) for _, labels in blocks]
+    x = np.concatenate([bx for bx, _ in blocks], dtype=np.float32)
+    labels = np.concatenate([bl for _, bl in blocks], dtype=np.int64)
+    del blocks
+
+    # Returns features, ASPRS manual labels, and the rows in each granule
+    return x, labels, rows
+
+
+def get_external_dmatrix(filenames, cache_prefix, args, ref=None):
+
+    # XGBoost keeps its quantized pages on disk, so only one granule is
+    # in memory at a time
+    it = GranuleIter(filenames,
+                     cache_prefix,
+                     feature_cache.get_cache(args),
+                     args.verbose,
+                     args.prefetch)
+    if hasattr(xgb, 'ExtMemQuantileDMatrix'):
+        return xgb.ExtMemQuantileDMatrix(it,
+                                         nthread=args.nthread or None,
+                                         ref=ref)
+    return xgb.DMatrix(it, nthread=args.nthread or None)
+
+
+def train_external(filenames, held_out, args, stats):
+
+    with tempfile.TemporaryDirectory(
+            dir=args.external_memory_dir) as cache_dir:
 
-        # Save the columns to the master dataframe
-        df = pd.concat([df, d])
+        train_filenames = [fn for fn, h in zip(filenames, held_out) if not h]
+        val_filenames = [fn for fn, h in zip(filenames, held_out) if h]
+
+        with stats.stage('extract') as record:
+            dtrain = get_external_dmatrix(train_filenames,
+                                          os.path.join(cache_dir, 'train'),
+                                          args)
+            dval = None
+            if val_filenames:
+                dval = get_external_dmatrix(
+                    val_filenames,
+                    os.path.join(cache_dir, 'validation'),
+                    args,
+                    ref=dtrain)
+            record['rows'] = dtrain.num_row()
+
+        booster = fit(dtrain, dval, args, stats)
+
+        # Free the pages before their directory is removed
+        del dtrain, dval
+
+    save(booster, args, stats)
 
     if args.verbose:
-        print(f'Final dataframe = {df.shape}', file=sys.stderr)
-        print(df.describe(), file=sys.stderr)
+        print_importances(booster)
 
-    algorithms = [
-        'bathypathfinder',
-        'coastnet',
-        'cshelph',
-        'medianfilter',
-        'openoceanspp',
-        'qtrees',
-        ]
 
+def main(args):
+
+    # Show args
     if args.verbose:
-        x = df['manual_label'].unique()
-        print(f'unique(ref): {x}', file=sys.stderr)
-        for col in algorithms:
-            x = df[col].unique()
-            print(f'unique({col}): {x}', file=sys.stderr)
+        print(args, file=sys.stderr)
 
-    features = algorithms.copy()
-    features.append('geoid_corr_h')
-    features.append('surface_h')
-    features.append('density')
+    # Get the filenames
+    filenames = photon_io.glob_photons(args.input_glob, args.store)
 
     if args.verbose:
-        print('Features:', features, file=sys.stderr)
+        print(filenames, file=sys.stderr)
+        print(f'{len(filenames)} total files', file=sys.stderr)
+
+    stats = profiling.get_stats(args, 'train')
 
-    x = df[df.columns.intersection(features)].copy()
-    y = df['manual_label'].copy()
+    # Granules held out for early stopping
+    held_out = split_granules(filenames, args.validation_fraction)
 
-    # Replace 'unknown' with 'unclassified'
-    y[y == 1] = 0
+    if args.verbose:
+        print(f'{held_out.sum()} validation files', file=sys.stderr)
 
-    # Replace 'water column' with 'unclassified'
-    y[y == 45] = 0
+    if args.external_memory:
+        train_external(filenames, held_out, args, stats)
+        return
 
-    # Make labels consecutive
-    y[y == 40] = 1
-    y[y == 41] = 2
+    # Extract features from each granule
+    with stats.stage('extract') as record:
+        x, labels, rows = get_training_data(filenames, args, stats)
+        y = features.map_labels(labels)
+        del labels
+        record['rows'] = len(y)
 
     if args.verbose:
+        df = pd.DataFrame(x, columns=features.FEATURES, copy=False)
+        print(f'Final features = {x.shape}', file=sys.stderr)
+        print(f'unique(ref): {np.unique(y)}', file=sys.stderr)
+        for col in features.ALGORITHMS:
+            print(f'unique({col}): {df[col].unique()}', file=sys.stderr)
+        print('Features:', features.FEATURES, file=sys.stderr)
         print('X=', file=sys.stderr)
-        print(x.describe(), file=sys.stderr)
+        print(df.describe(), file=sys.stderr)
         print('Y=', file=sys.stderr)
-        print(y.describe(), file=sys.stderr)
-
-    # Create the classifier
-    max_depth = 6
-    clf = xgb.XGBClassifier(device='cuda', max_depth=max_depth)
+        print(pd.Series(y).describe(), file=sys.stderr)
+        del df
 
-    if args.verbose:
-        print('Fitting...', file=sys.stderr)
+    with stats.stage('quantize', len(y)):
+        dtrain, dval = get_split_dmatrices(x,
+                                           y,
+                                           np.repeat(held_out, rows),
+                                           args.nthread)
 
-    clf.fit(x, y)
+    booster = fit(dtrain, dval, args, stats)
+    del dtrain, dval
 
+    # Read and density are summed over the granules, so they can add up
+    # to more than extract when granules are extracted in parallel
     if args.verbose:
-        print(f'Saving to {args.model_filename}', file=sys.stderr)
+        print(f'Stage\tSeconds', file=sys.stderr)
+        for stage, seconds in stats.totals.items():
+            print(f'{stage}\t{seconds:0.3f}', file=sys.stderr)
 
-    clf.save_model(args.model_filename)
+    save(booster, args, stats)
 
     if args.verbose:
         print('Getting predictions...', file=sys.stderr)
 
-    p = clf.predict(x)
+        with stats.stage('predict', len(y)):
+            p = booster.inplace_predict(x).argmax(axis=1)
+
+        # sklearn is slow to import, and only needed here
+        from sklearn.metrics import classification_report
+        from sklearn.metrics import f1_score
+        from sklearn.metrics import balanced_accuracy_score
 
-    if args.verbose:
         r = classification_report(y, p, digits=3)
         f1 = f1_score(y, p, average='weighted')
         ba = balanced_accuracy_score(y, p)
@@ -161,19 +442,20 @@ def main(args):
         print(f'Weighted F1\t{f1:.3f}', file=sys.stderr)
         print(f'Balanced accuracy\t{ba:.3f}', file=sys.stderr)
 
-        # Get feature importances
-        print(f'{"col":>20}{"importance":>20}', file=sys.stderr)
-        for n, col in enumerate(x.columns):
-            print(f'{col:>20}{clf.feature_importances_[n]:20.5f}',
-                  file=sys.stderr)
+        print_importances(booster)
 
     if args.permutation_importances:
         print('Getting permutation importances...', file=sys.stderr)
-        r = permutation_importance(clf,
-                                   x,
-                                   y,
-                                   n_repeats=10,
-                                   random_state=0)
+        from sklearn.inspection import permutation_importance
+        clf = xgb.XGBClassifier()
+        clf.load_model(args.model_filename)
+        x = pd.DataFrame(x, columns=features.FEATURES, copy=False)
+        with stats.stage('permutation_importance', len(y)):
+            r = permutation_importance(clf,
+                                       x,
+                                       y,
+                                       n_repeats=10,
+                                       random_state=0)
         print(r, file=sys.stderr)
 
         for i in r.importances_mean.argsort()[::-1]:
@@ -183,6 +465,43 @@ def main(args):
                   file=sys.stderr)
 
 
+def add_fit_arguments(parser):
+
+    # Training options, shared with cross_validate.py
+    parser.add_argument(
+        '-e', '--epochs',
+        type=int,
+        default=N_ESTIMATORS,
+        help='Maximum number of boosting rounds')
+    parser.add_argument(
+        '--validation-fraction',
+        type=float,
+        default=VALIDATION_FRACTION,
+        help='Fraction of the granules held out for early stopping,'
+             ' 0 to train for every epoch')
+    parser.add_argument(
+        '--early-stopping-rounds',
+        type=int,
+        default=EARLY_STOPPING_ROUNDS,
+        help='Stop once the validation metric has not improved for this'
+             ' many rounds')
+    parser.add_argument(
+        '--stopping-metric',
+        default=DEFAULT_STOPPING_METRIC,
+        choices=STOPPING_METRICS.keys(),
+        help='Validation metric for early stopping')
+    parser.add_argument(
+        '-d', '--device',
+        default=DEFAULT_DEVICE,
+        choices=DEVICES,
+        help='Training device')
+    parser.add_argument(
+        '-t', '--nthread',
+        type=int,
+        default=0,
+        help='Number of training threads, 0 for all cores')
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(
@@ -193,14 +512,57 @@ if __name__ == "__main__":
     parser.add_argument(
         '-p', '--permutation-importances', action='store_true',
         help='Compute permutation importances')
-    parser.add_argument(
-        '-e', '--epochs',
-        type=int,
-        help='Number of training epochs')
     parser.add_argument(
         '-m', '--model-filename',
         type=str,
         help='Specify output model filename')
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of granules to extract in parallel')
+    add_fit_arguments(parser)
+    parser.add_argument(
+        '--store',
+        type=str,
+        help='Read granules from this photon store, matching the glob'
+             ' against granule names')
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=photon_io.PREFETCH_DEPTH,
+        help='Number of granules to read ahead when extracting in this'
+             ' process, or with --external-memory')
+    parser.add_argument(
+        '-x', '--external-memory', action='store_true',
+        help='Train from disk, one granule in memory at a time')
+    parser.add_argument(
+        '--external-memory-dir',
+        type=str,
+        help='Directory for the external memory pages')
+    parser.add_argument(
+        '--stats',
+        type=str,
+        help="Append per stage timings as JSON lines to this file, or"
+             " '-' for stderr")
+    parser.add_argument(
+        '--profile',
+        type=str,
+        help='Write a cProfile dump of the main process to this file, or a'
+             ' pyinstrument report if it ends in .html')
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        default=feature_cache.DEFAULT_CACHE_DIR,
+        help='Directory for cached granule features')
+    parser.add_argument(
+        '--cache-max-gb',
+        type=float,
+        default=feature_cache.DEFAULT_MAX_GB,
+        help='Size limit of the feature cache')
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='Do not read or write cached features')
     parser.add_argument(
         'input_glob',
         type=str,
@@ -208,4 +570,5 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    main(args)
+    with profiling.profile(args.profile):
+        main(args)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Check that training and classification build the same features
+
+A synthetic granule is written to a temporary directory, and its
+features are built by train.extract, with and without the feature
+cache, and by classify.classify and classify.classify_stream. The model
+is only given the features, so they must be identical, not just close.
+The classify paths use a small model fit to the granule, so the check
+does not depend on the feature count of a released model.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import numpy as np
+import xgboost as xgb
+
+APPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..',
+                        'apps')
+sys.path.insert(0, APPS_DIR)
+
+import classify  # noqa: E402
+import feature_cache  # noqa: E402
+import features  # noqa: E402
+import model_registry  # noqa: E402
+import photon_io  # noqa: E402
+import profiling  # noqa: E402
+import synthetic  # noqa: E402
+import train  # noqa: E402
+
+# Number of chunks classify_stream splits the granule into
+STREAM_CHUNKS = 4
+
+# Boosting rounds of the model fit to the granule
+ROUNDS = 2
+
+
+def capture_features(f, *args, **kwargs):
+
+    # Returns the feature matrix that f gives the model, stacked over
+    # every chunk
+    blocks = []
+    predict = classify.predict
+
+    def capture(clf, x):
+        blocks.append(x.copy())
+        return predict(clf, x)
+
+    classify.predict = capture
+    try:
+        f(*args, **kwargs)
+    finally:
+        classify.predict = predict
+    return np.concatenate(blocks)
+
+
+def fit_model(x, labels, model_filename):
+
+    dtrain = train.get_dmatrix(x, features.map_labels(labels))
+    booster = xgb.train(train.get_params('cpu'), dtrain, ROUNDS)
+    model_registry.save_model(booster, model_filename)
+
+
+def get_stream_memory(model_filename, rows):
+
+    # A memory cap that streams the granule in a few chunks
+    classify.load_model(model_filename)
+    chunk_rows = max(1, rows // STREAM_CHUNKS)
+    return (profiling.get_rss() +
+            classify.STREAM_RESERVE_BYTES +
+            chunk_rows * classify.STREAM_ROW_BYTES)
+
+
+def main(args):
+
+    # Show args
+    if args.verbose:
+        print(args, file=sys.stderr)
+
+    n = int(args.size)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+
+        fn = os.path.join(tmpdir, 'granule.csv')
+        photon_io.write_photons(synthetic.get_granule(n, args.seed), fn)
+        cache = feature_cache.FeatureCache(os.path.join(tmpdir, 'cache'))
+
+        results = {}
+        x, labels, _ = train.extract(fn, None)
+        results['extract'] = x
+
+        model_filename = os.path.join(tmpdir, 'model.json')
+        fit_model(x, labels, model_filename)
+
+        # The first call fills the cache, and the second reads it
+        results['extract_cache_miss'] = train.extract(fn, cache)[0]
+        results['extract_cache_hit'] = train.extract(fn, cache)[0]
+
+        df = photon_io.read_photons(fn, classify.INPUT_COLUMNS)
+        results['classify'] = capture_features(classify.classify,
+                                               df,
+                                               False,
+                                               model_filename)
+
+        output_filename = os.path.join(tmpdir, 'classified.csv')
+        results['classify_stream'] = capture_features(
+            classify.classify_stream,
+            fn,
+            output_filename,
+            model_filename,
+            False,
+            get_stream_memory(model_filename, n))
+
+    failures = 0
+    expected = results['extract']
+
+    print('Path'
+          '\tRows'
+          '\tEqual')
+
+    for name, x in results.items():
+        equal = x.shape == expected.shape and np.array_equal(x, expected)
+        print(f'{name}'
+              f'\t{len(x)}'
+              f'\t{equal}')
+
+        if not equal:
+            failures += 1
+            if args.verbose and x.shape == expected.shape:
+                for i, c in enumerate(features.FEATURES):
+                    diff = np.count_nonzero(x[:, i] != expected[:, i])
+                    if diff:
+                        print(f'\t{c}\t{diff} rows differ', file=sys.stderr)
+
+    if failures:
+        print(f'{failures} paths do not build the same features as'
+              f' train.extract', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Check that training and classification build the'
+                    ' same features')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Show the features that differ')
+    parser.add_argument(
+        '-n', '--size', type=float, default=1e5,
+        help='Number of photons in the granule')
+    parser.add_argument(
+        '-s', '--seed', type=int, default=0,
+        help='Random seed')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Check the startup cost of the apps with python -X importtime
+
+Each app is imported in a fresh interpreter a few times, and the
+fastest cumulative import time is compared with the app's budget. Heavy
+optional dependencies must not be imported at startup: they are only
+imported by the code paths that use them.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+APPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..',
+                        'apps')
+
+# Import time budget in ms, and packages that must not be imported.
+# XGBoost imports most of sklearn itself, including sklearn.metrics, so
+# train can only avoid sklearn.inspection.
+BUDGETS = {
+    'classify': (1000, ['sklearn', 'xgboost', 'treelite', 'tl2cgen']),
+    'score': (1000, ['sklearn', 'xgboost']),
+    'train': (2500, ['sklearn.inspection']),
+    }
+
+
+def get_import_times(app):
+
+    # Returns (module, self us, cumulative us) for each imported module
+    result = subprocess.run([sys.executable, '-X', 'importtime',
+                             '-c', f'import {app}'],
+                            cwd=APPS_DIR,
+                            capture_output=True,
+                            text=True,
+                            check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        times.append((module.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+def main(args):
+
+    # Show args
+    if args.verbose:
+        print(args, file=sys.stderr)
+
+    failures = 0
+
+    print(f'App'
+          f'\tBudget'
+          f'\tImport ms'
+          f'\tForbidden')
+
+    for app, (budget, forbidden) in BUDGETS.items():
+
+        # The first import also compiles the app, so keep the fastest
+        runs = [get_import_times(app) for _ in range(args.repeat)]
+        times = min(runs, key=lambda t: t[-1][2])
+        ms = times[-1][2] / 1000
+
+        modules = [m for m, _, _ in times]
+        found = sorted({f for f in forbidden for m in modules
+                        if m == f or m.startswith(f + '.')})
+
+        print(f'{app}'
+              f'\t{budget}'
+              f'\t{ms:0.0f}'
+              f'\t{",".join(found)}')
+
+        if args.verbose:
+            for m, self_us, _ in sorted(times, key=lambda t: -t[1])[:10]:
+                print(f'\t{m}\t{self_us / 1000:0.1f} ms', file=sys.stderr)
+
+        if ms > budget * args.scale or found:
+            failures += 1
+
+    if failures:
+        print(f'{failures} apps are over budget, or import a forbidden'
+              f' package', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Check the import time of the apps')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Show the slowest modules of each app')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='Number of imports of each app, keeping the fastest')
+    parser.add_argument(
+        '-s', '--scale', type=float, default=1.0,
+        help='Scale the budgets, for slower machines')
+
+    args = parser.parse_args()
+
+    main(args)